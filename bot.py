@@ -1,25 +1,49 @@
 # --- Импорты ---
 from telegram.constants import ParseMode
-import atexit
 import logging
 import re
 import os
 import base64
 import json
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict, Set
-from collections import defaultdict, deque
+from typing import Optional, List, Dict, Set, Tuple, Iterator
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload, MediaIoBaseUpload
+import google_auth_httplib2
+import httplib2
 import openpyxl # type: ignore
 import warnings
 import sys
 import io
+import pickle
+import threading
 import asyncio
+import bisect
+import math
+import functools
+import time
 from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+# python-calamine — быстрый (Rust) reader xlsx из requirements.txt; если пакет
+# не удалось установить (нет wheel для платформы), лист читается через openpyxl
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+# uvloop — необязательный более быстрый цикл событий asyncio (Linux/macOS)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# orjson — необязательное ускорение разбора JSON; без него используется стандартный json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # --- Подавление предупреждений от openpyxl ---
 warnings.filterwarnings("ignore", message="Data Validation extension is not supported", category=UserWarning)
@@ -41,8 +65,8 @@ SCOPES = ['https://www.googleapis.com/auth/drive']
 # Путь к директории для хранения локальных кэшированных файлов
 LOCAL_CACHE_DIR = "./local_cache"
 # --- Глобальные переменные ---
-# Путь к файлу учетных данных Google
-CREDENTIALS_FILE: str = ""
+# Учетные данные сервисного аккаунта Google (разобранный JSON)
+CREDENTIALS_INFO: Dict = {}
 # Токен Telegram бота
 TELEGRAM_TOKEN: str = ""
 # ID родительской папки в Google Drive
@@ -65,12 +89,65 @@ LAST_FILE_DATE: Optional[datetime] = None
 LAST_FILE_DRIVE_TIME: Optional[datetime] = None
 # Локальный путь к последнему файлу
 LAST_FILE_LOCAL_PATH: Optional[str] = None
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Пометка в конце обрезанной строки сообщения
+TRUNCATED_SUFFIX = "<i>... (обрезано)</i>"
+# Сколько серийных номеров можно искать одним запросом
+MAX_NUMBERS_PER_QUERY = 10
+# Как часто поиск сверяет время изменения файла в Google Drive (в секундах)
+DRIVE_MTIME_TTL = int(os.getenv("DRIVE_MTIME_TTL", 60))
+# Когда время изменения файла в Drive проверялось последний раз (time.monotonic())
+last_drive_check: float = 0.0
+# Не даёт поиску и /refresh одновременно перезаписывать локальный файл.
+# Создаётся в post_init: на Python < 3.10 примитивы asyncio привязываются
+# к циклу событий, существующему в момент создания
+download_lock: Optional[asyncio.Lock] = None
+# Метаданные последнего файла склада (ID, дата, время в Drive, локальный путь)
+LAST_FILE_META_PATH = os.path.join(LOCAL_CACHE_DIR, "last_file.json")
+# Размер пула потоков для блокирующих вызовов (Drive API, openpyxl).
+# Пул один на процесс и устанавливается пулом по умолчанию для цикла событий
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", 16))
+# Время жизни кэша проверки прав на запись в файлы списков (в секундах)
+WRITE_PERMISSION_TTL = 60
+# Кэш прав на запись: file_id -> (время проверки, canEdit)
+write_permission_cache: Dict[str, Tuple[float, bool]] = {}
+# Кэш индексов Excel файлов: путь -> (mtime файла, СН -> строки листа)
+sheet_index_cache: Dict[str, Tuple[float, Dict[str, List[tuple]]]] = {}
+# Блокировка построения индекса: файл разбирает только один поток
+sheet_index_lock = threading.Lock()
+# Выполняющиеся поиски: (путь, mtime, номера) -> future с результатом
+search_inflight: Dict[tuple, asyncio.Future] = {}
+# Суффикс файла с сохранённым индексом листа рядом с локальной копией Excel
+INDEX_SIDECAR_SUFFIX = ".idx.pkl"
+# Метаданные файлов списков: file_id -> (mimeType, name); не меняются при записи
+list_file_meta_cache: Dict[str, Tuple[str, str]] = {}
 # Пул потоков для параллельной обработки
-executor = ThreadPoolExecutor(max_workers=4)
+executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="bot-io")
+# Сколько запросов к Drive API из обработчиков может выполняться одновременно.
+# Меньше размера пула: медленный Drive не занимает все потоки, нужные поиску
+DRIVE_MAX_CONCURRENCY = int(os.getenv("DRIVE_MAX_CONCURRENCY", 8))
+# Создаётся в post_init, как и download_lock
+drive_semaphore: Optional[asyncio.Semaphore] = None
+
+# Строка файла списка пользователей: необязательный @ и username Telegram
+# (латиница, цифры и _, от 3 до 32 символов); допускается BOM в начале файла
+USERNAME_LINE_RE = re.compile(rb'^(?:\xef\xbb\xbf)?[ \t]*@?([A-Za-z0-9_]{3,32})[ \t]*\r?$', re.MULTILINE)
+# Тот же шаблон username для проверки аргументов /whitelist и /blacklist
+USERNAME_RE = re.compile(r'[A-Za-z0-9_]{3,32}')
+# Имя файла склада: АПП_Склад_ДДММГГ_<город>.xlsm
+WAREHOUSE_FILENAME_RE = re.compile(r'^АПП_Склад_(\d{6})_' + re.escape(CITY) + r'\.xlsm$')
+# Названия месяцев в именах папок архива ("01 - январь" и т.д.)
+MONTH_NAMES = ("январь", "февраль", "март", "апрель", "май", "июнь",
+               "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь")
+# Символы, недопустимые в серийном номере (всё, кроме латиницы, цифр и дефиса)
+SN_INVALID_CHARS_RE = re.compile(r'[^A-Za-z0-9\-]')
 
 # --- Разрешённые пользователи (администраторы) ---
 # Список пользователей с правами администратора
 ALLOWED_USERS = {'tupikin_ik', 'yoptvayou'}
+# Нормализованные имена администраторов для быстрой проверки без аллокаций
+ALLOWED_USERS_LC = frozenset(u.casefold() for u in ALLOWED_USERS)
 
 # --- Защита от DDoS ---
 # Лимиты сообщений (количество сообщений за период)
@@ -80,26 +157,53 @@ MESSAGE_LIMITS = {
     'day': 1000     # 1000 сообщений в день
 }
 
-# Хранилище для отслеживания активности пользователей
-user_activity: Dict[str, Dict[str, deque]] = defaultdict(lambda: {
-    'minute': deque(),
-    'hour': deque(),
-    'day': deque()
-})
+# Длительность периодов лимитов в секундах
+PERIOD_SECONDS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+# Параметры корзин лимитера, вычисленные один раз:
+# (период, ёмкость корзины, скорость пополнения в токенах в секунду)
+_BUCKET_RATES = tuple(
+    (period, limit, limit / PERIOD_SECONDS[period]) for period, limit in MESSAGE_LIMITS.items()
+)
+# Самый длинный период лимитов (в секундах)
+_LONGEST_PERIOD = max(PERIOD_SECONDS.values())
+
+# Лимит исходящих сообщений бота в секунду (ниже глобального лимита Telegram в 30)
+SEND_MAX_RATE = 28
+# Число повторных попыток отправки после ответа Telegram RetryAfter (429)
+SEND_MAX_RETRIES = 3
+
+# Интервал фоновой очистки состояния лимитов (в секундах)
+RATE_LIMIT_GC_INTERVAL = 3600
+
+# Хранилище для отслеживания активности пользователей (token bucket):
+# для каждого периода — число оставшихся токенов, в 'last' — время
+# последнего пополнения (time.monotonic())
+# Ключ — числовой ID пользователя Telegram (username может отсутствовать или смениться)
+user_activity: Dict[int, Dict[str, float]] = {}
+# Последний известный username пользователя (для логов и /reset_bans)
+user_names: Dict[int, str] = {}
 
 # Блокировка пользователей (черный список)
-banned_users: Set[str] = set()
-# Время блокировки пользователей (в минутах)
-user_ban_times: Dict[str, int] = {}
-# Время начала блокировки
-user_ban_start_times: Dict[str, datetime] = {}
+banned_users: Set[int] = set()
+# Шаг увеличения времени блокировки (в секундах)
+BAN_STEP_SECONDS = 10 * 60
+# Время блокировки пользователей (в секундах)
+user_ban_times: Dict[int, int] = {}
+# Время окончания блокировки (значение time.monotonic())
+user_ban_until: Dict[int, float] = {}
 
 # --- Функции для работы с учетными данными ---
-def get_credentials_path() -> str:
+def get_credentials_info() -> Dict:
     """
     Декодирует Google Credentials из переменной окружения.
+    Учетные данные остаются только в памяти и не записываются на диск.
     Returns:
-        str: Путь к временному файлу с учетными данными
+        Dict: Разобранный JSON сервисного аккаунта
     Raises:
         RuntimeError: Если переменная окружения GOOGLE_CREDS_BASE64 не найдена
     """
@@ -108,16 +212,10 @@ def get_credentials_path() -> str:
     if not encoded:
         raise RuntimeError("GOOGLE_CREDS_BASE64 не найдена!")
     try:
-        # Расшифровываем данные и сохраняем во временный файл
-        decoded = base64.b64decode(encoded).decode('utf-8')
-        creds = json.loads(decoded)
-        temp_path = "temp_google_creds.json"
-        with open(temp_path, 'w') as f:
-            json.dump(creds, f)
-        logger.info(f"✅ Учетные данные сохранены: {temp_path}")
-        # Регистрируем функцию для удаления временного файла при выходе
-        atexit.register(lambda: os.remove(temp_path) if os.path.exists(temp_path) else None)
-        return temp_path
+        # Расшифровываем данные (JSON разбирается прямо из байтов)
+        creds = json_loads(base64.b64decode(encoded))
+        logger.info("✅ Учетные данные загружены")
+        return creds
     except Exception as e:
         logger.error(f"❌ Ошибка декодирования GOOGLE_CREDS_BASE64: {e}")
         raise
@@ -128,9 +226,10 @@ def init_config():
     Raises:
         RuntimeError: Если не все необходимые переменные окружения установлены
     """
-    global CREDENTIALS_FILE, TELEGRAM_TOKEN, PARENT_FOLDER_ID, TEMP_FOLDER_ID, ROOT_FOLDER_YEAR, BLACKLIST_FILE_ID, WHITELIST_FILE_ID, TIMEZONE_OFFSET
-    # Получаем путь к учетным данным
-    CREDENTIALS_FILE = get_credentials_path()
+    global CREDENTIALS_INFO, TELEGRAM_TOKEN, PARENT_FOLDER_ID, TEMP_FOLDER_ID, ROOT_FOLDER_YEAR, BLACKLIST_FILE_ID, WHITELIST_FILE_ID, TIMEZONE_OFFSET
+    # Получаем учетные данные; клиенты Drive должны пересоздаться с новыми
+    CREDENTIALS_INFO = get_credentials_info()
+    reset_google_clients()
     # Получаем токен Telegram бота
     TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
     # Получаем ID родительской папки
@@ -157,27 +256,61 @@ def init_config():
     logger.info(f"📁 Локальный кэш: {os.path.abspath(LOCAL_CACHE_DIR)}")
 
 # --- Класс для работы с Google API ---
-class GoogleServices:
+# HTTP-клиенты Google API, по одному на поток
+_thread_http = threading.local()
+
+def build_thread_safe_request(http, *args, **kwargs) -> HttpRequest:
     """
-    Singleton класс для работы с Google Drive API.
-    Этот класс обеспечивает единственный экземпляр соединения с Google Drive API,
+    Создаёт запрос к Google API с HTTP-соединением текущего потока.
+    httplib2.Http не потокобезопасен, а запросы к Drive выполняются
+    параллельно в пуле потоков, поэтому у каждого потока свой объект.
+    Внутри потока он переиспользуется: соединение остаётся открытым
+    (keep-alive), и TLS-рукопожатие не повторяется на каждый запрос.
+    Args:
+        http: Авторизованный HTTP-клиент сервиса (источник учётных данных)
+    Returns:
+        HttpRequest: Запрос, привязанный к HTTP-соединению потока
+    """
+    cached = getattr(_thread_http, 'client', None)
+    # После смены учётных данных (reset_google_clients) клиент создаётся заново
+    if cached is None or cached[0] is not http.credentials:
+        cached = (http.credentials, google_auth_httplib2.AuthorizedHttp(http.credentials, http=httplib2.Http()))
+        _thread_http.client = cached
+    return HttpRequest(cached[1], *args, **kwargs)
+
+@functools.cache
+def drive_service():
+    """
+    Возвращает сервис Google Drive API.
+    Сервис создаётся при первом вызове и затем переиспользуется,
     что позволяет избежать многократного создания соединений.
+    Returns:
+        Resource: Сервис Google Drive
     """
-    # Статический атрибут для хранения экземпляра класса
-    _instance = None
-    def __new__(cls):
-        """
-        Переопределение метода __new__ для реализации паттерна Singleton.
-        Returns:
-            GoogleServices: Единственный экземпляр класса
-        """
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            # Создаем учетные данные из файла
-            creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-            # Инициализируем сервис Google Drive
-            cls._instance.drive = build('drive', 'v3', credentials=creds)
-        return cls._instance
+    # Создаем учетные данные из разобранного JSON
+    creds = Credentials.from_service_account_info(CREDENTIALS_INFO, scopes=SCOPES)
+    # Инициализируем сервис Google Drive по встроенному в библиотеку
+    # discovery-документу: без сетевого запроса и без файлового кэша
+    return build(
+        'drive', 'v3',
+        credentials=creds,
+        requestBuilder=build_thread_safe_request,
+        cache_discovery=False,
+        static_discovery=True,
+    )
+
+async def run_drive_call(func, *args, **kwargs):
+    """
+    Выполняет блокирующий вызов Drive API в пуле потоков, ограничивая
+    число одновременных вызовов семафором drive_semaphore.
+    Args:
+        func: Блокирующая функция
+        *args, **kwargs: Аргументы функции
+    Returns:
+        Результат func
+    """
+    async with drive_semaphore:
+        return await asyncio.to_thread(func, *args, **kwargs)
 
 # --- Класс управления доступом ---
 class AccessManager:
@@ -194,53 +327,79 @@ class AccessManager:
         self.drive = drive_service
         self.blacklist = set()
         self.whitelist = set()
-    def download_list(self, file_id: str) -> List[str]:
+        # Кэш скачанных списков: file_id -> (modifiedTime, usernames)
+        self._list_cache: Dict[str, Tuple[str, Set[str]]] = {}
+        # Отсортированные копии списков для записи в Drive и вывода без пересортировки
+        self._sorted: Dict[str, List[str]] = {'whitelist': [], 'blacklist': []}
+    async def download_list(self, file_id: str) -> Set[str]:
         """
-        Скачивает список пользователей из Google Drive файла.
+        Асинхронно скачивает список пользователей из Google Drive файла.
+        Блокирующий вызов Drive API выполняется в пуле потоков,
+        чтобы не останавливать обработку остальных обновлений.
         Args:
             file_id (str): ID файла в Google Drive
         Returns:
-            List[str]: Список username пользователей (без @, в нижнем регистре)
+            Set[str]: Множество username пользователей (без @, в нижнем регистре)
+        """
+        return await run_drive_call(self._download_list_sync, file_id)
+
+    def _download_list_sync(self, file_id: str) -> Set[str]:
+        """
+        Синхронная реализация скачивания списка пользователей из Google Drive файла.
+        Args:
+            file_id (str): ID файла в Google Drive
+        Returns:
+            Set[str]: Множество username пользователей (без @, в нижнем регистре)
         """
         try:
-            # Получаем медиа-поток файла
-            request = self.drive.files().get_media(fileId=file_id)
-            file_data = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_data, request)
-            done = False
-            # Скачиваем файл
-            while not done:
-                status, done = downloader.next_chunk()
-            file_data.seek(0)
-            content = file_data.read().decode('utf-8')
-            # Обрабатываем содержимое файла
-            usernames = []
-            for line in content.splitlines():
-                # Очищаем строку: удаляем @, приводим к нижнему регистру, убираем пробелы
-                cleaned = line.strip().lower().replace('@', '')
-                if cleaned:
-                    usernames.append(cleaned)
+            # Сначала запрашиваем только время изменения: если файл не менялся,
+            # повторно скачивать его содержимое не нужно
+            info = self.drive.files().get(fileId=file_id, fields="modifiedTime").execute()
+            modified_time = info.get('modifiedTime')
+            cached = self._list_cache.get(file_id)
+            if cached and modified_time and cached[0] == modified_time:
+                logger.info(f"📋 Список {file_id} не изменился — используем кэш")
+                return cached[1]
+            # Список небольшой: скачиваем содержимое одним запросом сразу в bytes,
+            # без MediaIoBaseDownload и промежуточного BytesIO
+            content = self.drive.files().get_media(fileId=file_id).execute()
+            # Извлекаем username одним проходом регулярного выражения по байтам:
+            # строки, не похожие на username Telegram, отбрасываются.
+            # Регистр приводится один раз для всего файла, а не для каждой строки
+            usernames = {m.decode('ascii') for m in USERNAME_LINE_RE.findall(content.lower())}
+            if modified_time:
+                self._list_cache[file_id] = (modified_time, usernames)
             return usernames
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки списка из файла {file_id}: {e}")
-            return []
+            return set()
 
-    def update_lists(self):
+    async def update_lists(self):
         """
         Обновляет черный и белый списки пользователей из Google Drive файлов.
+        Оба файла скачиваются параллельно.
         """
-        # Загружаем белый список
+        started = time.monotonic()
+        # Скачиваем оба списка одновременно; для незаданных ID — пустая заглушка
+        whitelist, blacklist = await asyncio.gather(
+            self.download_list(WHITELIST_FILE_ID) if WHITELIST_FILE_ID else asyncio.sleep(0, result=set()),
+            self.download_list(BLACKLIST_FILE_ID) if BLACKLIST_FILE_ID else asyncio.sleep(0, result=set()),
+        )
+        # Обновляем белый список
         if WHITELIST_FILE_ID:
-            self.whitelist = set(self.download_list(WHITELIST_FILE_ID))
+            self.whitelist = set(whitelist)
+            self._sorted['whitelist'] = sorted(self.whitelist)
             logger.info(f"✅ Загружен белый список: {len(self.whitelist)} пользователей")
         else:
             logger.warning("⚠️ WHITELIST_FILE_ID не задан — белый список пуст")
-        # Загружаем черный список
+        # Обновляем черный список
         if BLACKLIST_FILE_ID:
-            self.blacklist = set(self.download_list(BLACKLIST_FILE_ID))
+            self.blacklist = set(blacklist)
+            self._sorted['blacklist'] = sorted(self.blacklist)
             logger.info(f"✅ Загружен чёрный список: {len(self.blacklist)} пользователей")
         else:
             logger.warning("⚠️ BLACKLIST_FILE_ID не задан — чёрный список пуст")
+        logger.info(f"⏱ Списки доступа загружены за {time.monotonic() - started:.3f} с")
 
     def is_allowed(self, username: str) -> bool:
         """
@@ -252,9 +411,9 @@ class AccessManager:
         """
         if not username:
             return False
-        username_lower = username.lower()
+        username_lower = username.casefold()
         # Администраторы всегда имеют доступ
-        if username_lower in {u.lower() for u in ALLOWED_USERS}:
+        if username_lower in ALLOWED_USERS_LC:
             return True
         # Чёрный список — запрещает доступ, даже если в белом
         if username_lower in self.blacklist:
@@ -265,119 +424,254 @@ class AccessManager:
         # Если белый список пуст — разрешаем всех, кроме чёрного
         return True
 
+    def add_users(self, list_name: str, usernames) -> None:
+        """
+        Добавляет пользователей в список, поддерживая его отсортированную копию.
+        Args:
+            list_name (str): Имя списка ('whitelist' или 'blacklist')
+            usernames: Username пользователей (без @, в нижнем регистре)
+        """
+        target = getattr(self, list_name)
+        ordered = self._sorted[list_name]
+        for u in usernames:
+            if u not in target:
+                target.add(u)
+                bisect.insort(ordered, u)
+
+    def remove_users(self, list_name: str, usernames) -> None:
+        """
+        Удаляет пользователей из списка, поддерживая его отсортированную копию.
+        Args:
+            list_name (str): Имя списка ('whitelist' или 'blacklist')
+            usernames: Username пользователей (без @, в нижнем регистре)
+        """
+        target = getattr(self, list_name)
+        ordered = self._sorted[list_name]
+        for u in usernames:
+            if u in target:
+                target.discard(u)
+                del ordered[bisect.bisect_left(ordered, u)]
+
+    def sorted_users(self, list_name: str) -> List[str]:
+        """
+        Возвращает список пользователей в алфавитном порядке (без сортировки на каждый вызов).
+        Args:
+            list_name (str): Имя списка ('whitelist' или 'blacklist')
+        Returns:
+            List[str]: Отсортированные username
+        """
+        return self._sorted[list_name]
+
 # Глобальная переменная для менеджера доступа
 access_manager: Optional[AccessManager] = None
 
 # --- Функции защиты от DDoS ---
-def check_user_limit(username: str) -> bool:
+def user_label(user_id: int) -> str:
+    """
+    Возвращает имя пользователя для логов.
+    Args:
+        user_id (int): ID пользователя Telegram
+    Returns:
+        str: Username пользователя, если он известен, иначе его ID
+    """
+    return user_names.get(user_id) or str(user_id)
+
+def check_user_limit(user_id: int, username: Optional[str] = None) -> bool:
     """
     Проверяет, превышает ли пользователь лимиты сообщений.
     Args:
-        username (str): Имя пользователя Telegram
+        user_id (int): ID пользователя Telegram
+        username (Optional[str]): Username пользователя (только для логов и /reset_bans)
     Returns:
         bool: True, если пользователь не заблокирован и лимиты не превышены
     """
+    # Администраторы не ограничиваются и не попадают в хранилище лимитов
+    if username and username.casefold() in ALLOWED_USERS_LC:
+        return True
+    if username:
+        user_names[user_id] = username
     # Проверяем, заблокирован ли пользователь
-    if username in banned_users:
+    if user_id in banned_users:
         # Проверяем, истекло ли время блокировки
-        if username in user_ban_start_times:
-            ban_duration = timedelta(minutes=user_ban_times.get(username, 10))
-            ban_start = user_ban_start_times[username]
-            if datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET) >= ban_start + ban_duration:
+        ban_until = user_ban_until.get(user_id)
+        if ban_until is not None:
+            now = time.monotonic()
+            if now >= ban_until:
                 # Время блокировки истекло, разблокируем пользователя
-                unban_user(username)
-                logger.info(f"🔓 Пользователь {username} разблокирован автоматически")
+                unban_user(user_id)
+                logger.info(f"🔓 Пользователь {user_label(user_id)} разблокирован автоматически")
                 # Удаляем информацию о блокировке
-                user_ban_start_times.pop(username, None)
-                user_ban_times.pop(username, None)
+                user_ban_until.pop(user_id, None)
+                user_ban_times.pop(user_id, None)
                 return True
             else:
                 # Пользователь всё ещё заблокирован, выводим время до разблокировки
-                remaining_time = ban_start + ban_duration - (datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET))
-                minutes_left = int(remaining_time.total_seconds() // 60)
-                logger.warning(f"⚠️ Пользователь {username} заблокирован. Осталось {minutes_left} минут")
+                minutes_left = ban_minutes_left(ban_until, now)
+                logger.warning(f"⚠️ Пользователь {user_label(user_id)} заблокирован. Осталось {minutes_left} минут")
                 return False
         else:
             # Время блокировки не указано, разблокируем
-            unban_user(username)
+            unban_user(user_id)
             return True
 
-    now = datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET)
-    # Очищаем устаревшие записи
-    for period, queue in user_activity[username].items():
-        # Исправленный код для timedelta
-        time_delta_key = period + 's'  # minute -> minutes, hour -> hours, day -> days
-        if time_delta_key in ['minutes', 'hours', 'days']:
-            delta = timedelta(**{time_delta_key: 1})
-            while queue and queue[0] <= now - delta:
-                queue.popleft()
-        else:
-            logger.warning(f"⚠️ Неподдерживаемый период: {period}")
-
-    # Проверяем лимиты
+    now = time.monotonic()
+    bucket = user_activity.get(user_id)
+    if bucket is None:
+        # Новый пользователь начинает с полными корзинами
+        bucket = {period: float(limit) for period, limit in MESSAGE_LIMITS.items()}
+        bucket['last'] = now
+        user_activity[user_id] = bucket
+    elapsed = now - bucket['last']
+    bucket['last'] = now
+    # Пополняем корзины пропорционально прошедшему времени (не выше лимита)
+    for period, limit, rate in _BUCKET_RATES:
+        bucket[period] = min(limit, bucket[period] + elapsed * rate)
+
+    # Проверяем лимиты: для сообщения нужен целый токен в каждой корзине
     for period, limit in MESSAGE_LIMITS.items():
-        if len(user_activity[username][period]) >= limit:
-            logger.warning(f"⚠️ Пользователь {username} превысил лимит {limit} сообщений за {period}")
-            ban_user(username)
+        if bucket[period] < 1:
+            logger.warning(f"⚠️ Пользователь {user_label(user_id)} превысил лимит {limit} сообщений за {period}")
+            ban_user(user_id)
             return False
-    # Добавляем текущее сообщение
-    for period in MESSAGE_LIMITS.keys():
-        user_activity[username][period].append(now)
+    # Списываем токен за текущее сообщение
+    for period in MESSAGE_LIMITS:
+        bucket[period] -= 1
     return True
 
-def ban_user(username: str):
+def ban_minutes_left(ban_until: float, now: float) -> int:
+    """
+    Сколько минут осталось до разблокировки, с округлением вверх:
+    пока блокировка действует, пользователь не увидит «0 минут».
+    Args:
+        ban_until (float): Время окончания блокировки (time.monotonic())
+        now (float): Текущее время (time.monotonic())
+    Returns:
+        int: Целое число минут, не меньше 1
+    """
+    return max(1, math.ceil((ban_until - now) / 60))
+
+def ban_user(user_id: int):
     """
     Блокирует пользователя.
     Args:
-        username (str): Имя пользователя Telegram
+        user_id (int): ID пользователя Telegram
     """
     # Определяем время блокировки (начинается с 10 минут, увеличивается на 10 каждые 10 минут)
-    ban_time = user_ban_times.get(username, 10)
-    user_ban_times[username] = ban_time + 10
-    user_ban_start_times[username] = datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET)
-    banned_users.add(username)
-    logger.info(f"🔒 Пользователь {username} заблокирован на {ban_time} минут")
-
-def unban_user(username: str):
+    ban_time = user_ban_times.get(user_id, BAN_STEP_SECONDS)
+    user_ban_times[user_id] = ban_time + BAN_STEP_SECONDS
+    # Храним сразу момент разблокировки, а не начало и длительность
+    user_ban_until[user_id] = time.monotonic() + ban_time
+    banned_users.add(user_id)
+    logger.info(f"🔒 Пользователь {user_label(user_id)} заблокирован на {ban_time // 60} минут")
+
+def unban_user(user_id: int):
     """
     Разблокирует пользователя.
     Args:
-        username (str): Имя пользователя Telegram
+        user_id (int): ID пользователя Telegram
     """
-    banned_users.discard(username)
-    logger.info(f"🔓 Пользователь {username} разблокирован")
+    banned_users.discard(user_id)
+    logger.info(f"🔓 Пользователь {user_label(user_id)} разблокирован")
     # Удаляем информацию о блокировке
-    user_ban_start_times.pop(username, None)
-    user_ban_times.pop(username, None)
+    user_ban_until.pop(user_id, None)
+    user_ban_times.pop(user_id, None)
 
-def reset_user_limits(username: str):
+def reset_user_limits(target: str):
     """
     Сбрасывает лимиты для пользователя.
     Args:
-        username (str): Имя пользователя Telegram
+        target (str): Username (без @, регистр не важен) или числовой ID пользователя Telegram
+    """
+    # Находим ID пользователя по username (или берём числовой ID напрямую)
+    target_lower = target.lower()
+    user_ids = [uid for uid, name in user_names.items() if name.lower() == target_lower]
+    if target.isdigit():
+        user_ids.append(int(target))
+    for user_id in user_ids:
+        # Удаляем состояние лимитера — при следующем сообщении корзины будут полными
+        user_activity.pop(user_id, None)
+        # Сбрасываем информацию о блокировке
+        user_ban_until.pop(user_id, None)
+        user_ban_times.pop(user_id, None)
+    logger.info(f"🔄 Лимиты для пользователя {target} сброшены")
+
+def prune_rate_limits() -> int:
+    """
+    Удаляет состояние лимитов пользователей, неактивных дольше суток,
+    если их блокировка уже истекла. За сутки простоя корзины пользователя
+    всё равно пополнились бы до лимита, поэтому удаление ничего не меняет.
+    Returns:
+        int: Количество удалённых пользователей
     """
-    if username in user_activity:
-        for period in MESSAGE_LIMITS.keys():
-            user_activity[username][period].clear()
-    logger.info(f"🔄 Лимиты для пользователя {username} сброшены")
-    # Сбрасываем информацию о блокировке
-    user_ban_start_times.pop(username, None)
-    user_ban_times.pop(username, None)
+    now = time.monotonic()
+    idle_cutoff = now - _LONGEST_PERIOD
+    removed = 0
+    for user_id in list(user_activity.keys() | user_ban_until.keys()):
+        bucket = user_activity.get(user_id)
+        if bucket and bucket['last'] > idle_cutoff:
+            continue
+        # Не трогаем пользователей с действующей блокировкой
+        if now < user_ban_until.get(user_id, 0.0):
+            continue
+        user_activity.pop(user_id, None)
+        banned_users.discard(user_id)
+        user_ban_until.pop(user_id, None)
+        user_ban_times.pop(user_id, None)
+        user_names.pop(user_id, None)
+        removed += 1
+    return removed
+
+async def gc_rate_limits():
+    """
+    Фоновая задача: раз в RATE_LIMIT_GC_INTERVAL секунд очищает
+    состояние лимитов неактивных пользователей.
+    """
+    while True:
+        await asyncio.sleep(RATE_LIMIT_GC_INTERVAL)
+        removed = prune_rate_limits()
+        if removed:
+            logger.info(f"🧹 Очищено состояние лимитов для {removed} неактивных пользователей")
 
-# --- Команда /whitelist ---
-async def manage_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def enforce_rate_limit(update: Update, user) -> bool:
     """
-    Управление белым списком: добавить, удалить, показать.
+    Проверяет лимиты DDoS и, если пользователь заблокирован,
+    сообщает ему, сколько ждать до разблокировки.
+    Args:
+        update (Update): Объект обновления от Telegram
+        user (User): Пользователь Telegram
+    Returns:
+        bool: True, если сообщение можно обрабатывать дальше
+    """
+    if check_user_limit(user.id, user.username):
+        return True
+    # Получаем время до разблокировки
+    ban_until = user_ban_until.get(user.id)
+    if ban_until is not None:
+        minutes_left = ban_minutes_left(ban_until, time.monotonic())
+        text = get_message('ddos_blocked_minutes', minutes=minutes_left)
+    else:
+        text = get_message('ddos_blocked')
+    await update.message.reply_text(text, parse_mode='HTML')
+    return False
+
+# --- Команды /whitelist и /blacklist ---
+async def _manage_list(update: Update, context: ContextTypes.DEFAULT_TYPE, *, list_name: str,
+                       label: str, label_genitive: str, exclusive_with: Optional[str] = None):
+    """
+    Общая логика управления списком доступа: добавить, удалить, показать.
     Доступно только администраторам.
-    Использование:
-      /whitelist show
-      /whitelist add @username1 @username2
-      /whitelist remove @username1 @username2
+    Args:
+        update (Update): Объект обновления от Telegram
+        context (ContextTypes.DEFAULT_TYPE): Контекст обработчика
+        list_name (str): Имя списка и команды ('whitelist' или 'blacklist')
+        label (str): Название списка для ответов ('Белый', 'Чёрный')
+        label_genitive (str): Название списка в родительном падеже ('белого списка')
+        exclusive_with (Optional[str]): Список, из которого пользователь удаляется при добавлении в этот
     """
     if not update.message or not update.effective_user:
         return
     user = update.effective_user
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
+    if not is_admin(user):
         await update.message.reply_text(get_message('admin_only'))
         return
 
@@ -388,256 +682,297 @@ async def manage_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if not args:
         await update.message.reply_text(
-            get_message('list_usage', list_type='whitelist'),
+            get_message('list_usage', list_type=list_name),
             parse_mode='HTML'
         )
         return
 
     action = args[0].lower()
-    usernames = [u.lstrip('@').lower() for u in args[1:]] if len(args) > 1 else []
+    # Разбираем имена один раз: без @, в нижнем регистре, без повторов
+    usernames = frozenset(u.lstrip('@').lower() for u in args[1:]) - {''}
+    target = getattr(access_manager, list_name)
 
     if action == "show":
-        if access_manager.whitelist:
-            whitelist_text = "\n".join([f"@{u}" for u in sorted(access_manager.whitelist)])
+        if target:
+            usernames_text = "\n".join([f"@{u}" for u in access_manager.sorted_users(list_name)])
             await update.message.reply_text(
                 get_message('list_show_header',
-                           list_type='Белый',
-                           count=len(access_manager.whitelist),
-                           usernames=whitelist_text),
+                           list_type=label,
+                           count=len(target),
+                           usernames=usernames_text),
                 parse_mode='HTML'
             )
         else:
             await update.message.reply_text(
-                get_message('list_show_empty', list_type='Белый')
+                get_message('list_show_empty', list_type=label)
             )
         return
 
-    elif action in ["add", "remove"]:
-        if not usernames:
-            await update.message.reply_text(
-                get_message('list_no_usernames')
-            )
-            return
-
-        # Проверка разрешений на запись в Google Drive перед изменением
-        gs = GoogleServices()
-        fm = FileManager(gs.drive)
-        can_write_whitelist = fm.check_write_permission(WHITELIST_FILE_ID)
-        can_write_blacklist = fm.check_write_permission(BLACKLIST_FILE_ID)
-
-        if not (can_write_whitelist and can_write_blacklist):
-            await update.message.reply_text(
-                get_message('list_no_write_permission', list_type='списков')
-            )
-            logger.warning(f"Администратор {user.username} попытался изменить списки, но у бота нет прав на запись.")
-            return
-
-        if action == "add":
-            added = []
-            already_in = []
-            for u in usernames:
-                if u not in access_manager.whitelist:
-                    access_manager.whitelist.add(u)
-                    added.append(u)
-                else:
-                    already_in.append(u)
-            
-            # Обновляем файл на Google Drive
-            success = fm.update_list_file(WHITELIST_FILE_ID, sorted(access_manager.whitelist))
-            if success:
-                msg_added = ', '.join([f'@{u}' for u in added]) if added else "—"
-                msg_already = ', '.join([f'@{u}' for u in already_in]) if already_in else "—"
-                await update.message.reply_text(
-                    get_message('list_update_success_add',
-                               list_type='Белый',
-                               added=msg_added,
-                               already_in=msg_already)
-                )
-                logger.info(f"Администратор {user.username} добавил в белый список: {added}")
-            else:
-                # Откатываем изменения в памяти, если запись не удалась
-                for u in added:
-                    access_manager.whitelist.discard(u)
-                await update.message.reply_text(
-                    get_message('list_update_error', list_type='белого списка')
-                )
-
-        elif action == "remove":
-            removed = []
-            not_found = []
-            for u in usernames:
-                if u in access_manager.whitelist:
-                    access_manager.whitelist.discard(u)
-                    removed.append(u)
-                else:
-                    not_found.append(u)
-            
-            # Обновляем файл на Google Drive
-            success = fm.update_list_file(WHITELIST_FILE_ID, sorted(access_manager.whitelist))
-            if success:
-                msg_removed = ', '.join([f'@{u}' for u in removed]) if removed else "—"
-                msg_not_found = ', '.join([f'@{u}' for u in not_found]) if not_found else "—"
-                await update.message.reply_text(
-                    get_message('list_update_success_remove',
-                               list_type='Белый',
-                               removed=msg_removed,
-                               not_found=msg_not_found)
-                )
-                logger.info(f"Администратор {user.username} удалил из белого списка: {removed}")
-            else:
-                # Откатываем изменения в памяти, если запись не удалась
-                for u in removed:
-                    access_manager.whitelist.add(u)
-                await update.message.reply_text(
-                    get_message('list_update_error', list_type='белого списка')
-                )
-    else:
+    if action not in ("add", "remove"):
         await update.message.reply_text(
             get_message('list_unknown_action'),
             parse_mode='HTML'
         )
-
-
-async def manage_blacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Управление чёрным списком: добавить, удалить, показать.
-    Доступно только администраторам.
-    Использование:
-      /blacklist show
-      /blacklist add @username1 @username2
-      /blacklist remove @username1 @username2
-    """
-    if not update.message or not update.effective_user:
-        return
-    user = update.effective_user
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
-        await update.message.reply_text(get_message('admin_only'))
-        return
-
-    if not access_manager:
-        await update.message.reply_text("❌ Система доступа не инициализирована.")
         return
 
-    args = context.args
-    if not args:
+    if not usernames:
         await update.message.reply_text(
-            get_message('list_usage', list_type='blacklist'),
-            parse_mode='HTML'
+            get_message('list_no_usernames')
         )
         return
-
-    action = args[0].lower()
-    usernames = [u.lstrip('@').lower() for u in args[1:]] if len(args) > 1 else []
-
-    if action == "show":
-        if access_manager.blacklist:
-            blacklist_text = "\n".join([f"@{u}" for u in sorted(access_manager.blacklist)])
-            await update.message.reply_text(
-                get_message('list_show_header',
-                           list_type='Чёрный',
-                           count=len(access_manager.blacklist),
-                           usernames=blacklist_text),
-                parse_mode='HTML'
-            )
-        else:
-            await update.message.reply_text(
-                get_message('list_show_empty', list_type='Чёрный')
-            )
+    # Имена, которые загрузчик списков не примет, в Drive не записываем:
+    # иначе они молча пропадут при следующей перезагрузке списков
+    invalid = sorted(u for u in usernames if not USERNAME_RE.fullmatch(u))
+    if invalid:
+        await update.message.reply_text(
+            get_message('list_invalid_usernames', usernames=", ".join(invalid))
+        )
         return
 
-    elif action in ["add", "remove"]:
-        if not usernames:
-            await update.message.reply_text(
-                get_message('list_no_usernames')
-            )
-            return
-
-        # Проверка разрешений на запись в Google Drive перед изменением
-        gs = GoogleServices()
-        fm = FileManager(gs.drive)
-        can_write_whitelist = fm.check_write_permission(WHITELIST_FILE_ID)
-        can_write_blacklist = fm.check_write_permission(BLACKLIST_FILE_ID)
-
-        if not (can_write_whitelist and can_write_blacklist):
-             await update.message.reply_text(
-                get_message('list_no_write_permission', list_type='списков')
-            )
+    # Проверка разрешений на запись в Google Drive перед изменением
+    fm = file_manager()
+    permissions = await run_drive_call(fm.check_write_permissions, [WHITELIST_FILE_ID, BLACKLIST_FILE_ID])
+    if not all(permissions.values()):
+        await update.message.reply_text(
+            get_message('list_no_write_permission', list_type='списков')
+        )
         logger.warning(f"Администратор {user.username} попытался изменить списки, но у бота нет прав на запись.")
         return
 
+    file_ids = {'whitelist': WHITELIST_FILE_ID, 'blacklist': BLACKLIST_FILE_ID}
+    moved: Set[str] = set()
     if action == "add":
-        added = []
-        already_in = []
-        for u in usernames:
-            if u not in access_manager.blacklist:
-                access_manager.blacklist.add(u)
-                # Автоматически удаляем из белого списка при добавлении в чёрный
-                if u in access_manager.whitelist:
-                    access_manager.whitelist.discard(u)
-                added.append(u)
-            else:
-                already_in.append(u)
-            
-        # Обновляем файлы на Google Drive
-        success_black = fm.update_list_file(BLACKLIST_FILE_ID, sorted(access_manager.blacklist))
-        success_white = fm.update_list_file(WHITELIST_FILE_ID, sorted(access_manager.whitelist)) # Обновляем белый список тоже
-            
-        if success_black and success_white:
-            msg_added = ', '.join([f'@{u}' for u in added]) if added else "—"
-            msg_already = ', '.join([f'@{u}' for u in already_in]) if already_in else "—"
-            await update.message.reply_text(
-                    get_message('list_update_success_add',
-                            list_type='Чёрный',
-                            added=msg_added,
-                            already_in=msg_already)
-            )
-            logger.info(f"Администратор {user.username} добавил в чёрный список: {added}")
+        changed = usernames - target
+        unchanged = usernames & target
+        access_manager.add_users(list_name, changed)
+        # Добавленные в этот список пользователи исключаются из парного
+        if exclusive_with:
+            moved = changed & getattr(access_manager, exclusive_with)
+            access_manager.remove_users(exclusive_with, moved)
+    else:
+        changed = usernames & target
+        unchanged = usernames - target
+        access_manager.remove_users(list_name, changed)
+
+    # Обновляем файлы на Google Drive (парный список — только если он изменился).
+    # В поток передаём копии: параллельная команда может изменить списки во время записи
+    success = await run_drive_call(fm.update_list_file, file_ids[list_name], list(access_manager.sorted_users(list_name)))
+    if success and moved:
+        success = await run_drive_call(fm.update_list_file, file_ids[exclusive_with], list(access_manager.sorted_users(exclusive_with)))
+
+    if not success:
+        # Откатываем изменения в памяти, если запись не удалась
+        if action == "add":
+            access_manager.remove_users(list_name, changed)
+            if moved:
+                access_manager.add_users(exclusive_with, moved)
         else:
-            # Откатываем изменения в памяти, если запись не удалась
-            for u in added:
-                access_manager.blacklist.discard(u)
-                # Восстанавливаем в белый список, если был удален
-                # (Логика восстановления может быть сложнее, опущена для простоты)
-            await update.message.reply_text(
-                get_message('list_update_error', list_type='чёрного списка')
-            )
+            access_manager.add_users(list_name, changed)
+        await update.message.reply_text(
+            get_message('list_update_error', list_type=label_genitive)
+        )
+        return
 
-    elif action == "remove":
-        removed = []
-        not_found = []
-        for u in usernames:
-            if u in access_manager.blacklist:
-                access_manager.blacklist.discard(u)
-                removed.append(u)
-            else:
-                not_found.append(u)
-            
-        # Обновляем файл на Google Drive
-        success = fm.update_list_file(BLACKLIST_FILE_ID, sorted(access_manager.blacklist))
-        if success:
-            msg_removed = ', '.join([f'@{u}' for u in removed]) if removed else "—"
-            msg_not_found = ', '.join([f'@{u}' for u in not_found]) if not_found else "—"
-            await update.message.reply_text(
-                    get_message('list_update_success_remove',
-                            list_type='Чёрный',
-                            removed=msg_removed,
-                            not_found=msg_not_found)
-            )
-            logger.info(f"Администратор {user.username} удалил из чёрного списка: {removed}")
-        else:
-            # Откатываем изменения в памяти, если запись не удалась
-            for u in removed:
-                access_manager.blacklist.add(u)
-            await update.message.reply_text(
-                get_message('list_update_error', list_type='чёрного списка')
-            )
+    msg_changed = ', '.join([f'@{u}' for u in sorted(changed)]) if changed else "—"
+    msg_unchanged = ', '.join([f'@{u}' for u in sorted(unchanged)]) if unchanged else "—"
+    if action == "add":
+        await update.message.reply_text(
+            get_message('list_update_success_add',
+                       list_type=label,
+                       added=msg_changed,
+                       already_in=msg_unchanged)
+        )
+        logger.info(f"Администратор {user.username} добавил в {label.lower()} список: {sorted(changed)}")
     else:
         await update.message.reply_text(
-            get_message('list_unknown_action'),
-            parse_mode='HTML'
+            get_message('list_update_success_remove',
+                       list_type=label,
+                       removed=msg_changed,
+                       not_found=msg_unchanged)
         )
+        logger.info(f"Администратор {user.username} удалил из {label_genitive}: {sorted(changed)}")
+
+async def manage_whitelist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Управление белым списком: добавить, удалить, показать.
+    Доступно только администраторам.
+    Использование:
+      /whitelist show
+      /whitelist add @username1 @username2
+      /whitelist remove @username1 @username2
+    """
+    await _manage_list(update, context, list_name='whitelist',
+                       label='Белый', label_genitive='белого списка')
+
+async def manage_blacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Управление чёрным списком: добавить, удалить, показать.
+    Добавленные в чёрный список пользователи удаляются из белого.
+    Доступно только администраторам.
+    Использование:
+      /blacklist show
+      /blacklist add @username1 @username2
+      /blacklist remove @username1 @username2
+    """
+    await _manage_list(update, context, list_name='blacklist',
+                       label='Чёрный', label_genitive='чёрного списка', exclusive_with='whitelist')
 
 # --- Ответы бота ---
+# Шаблоны сообщений бота (создаются один раз при импорте модуля, только для чтения)
+_MESSAGES = MappingProxyType({
+    'access_denied': (
+        "Ты кто такой, дядя?\n"
+        "Не в списке — не входи.\n"
+        "Хочешь доступ — плати бабки или лежи в багажнике до утра."
+    ),
+    'help': (
+        "О, смотри-ка — гость на складе!\n"
+        "Только не стой как лох у контейнера — говори, что надо.\n"
+        "• <code>/s 123456</code> — найти терминал по СН\n"
+        "• <code>/s 123456, 789012</code> — найти несколько терминалов по СН\n"    
+        "• <code>/ping</code> — проверить время отклика бота\n"
+        "• <code>@Sklad_bot 123456</code> — крикни в чатике, я найду\n"
+        "\n"
+        "<b>Только для админов:</b>\n"
+        "• <code>/whitelist show|add|remove [@username...]</code> — управление белым списком\n"
+        "• <code>/blacklist show|add|remove [@username...]</code> — управление чёрным списком\n"
+        "• <code>/path</code> — глянуть, что у нас в папке завалялось\n"
+        "• <code>/reload_lists</code> — обновить список предателей и своих\n"
+        "• <code>/restart</code> — перезапуск бота\n"
+        "• <code>/refresh</code> — обновления файла склада\n"
+        "• <code>/reset_bans</code> — сброс банов\n"
+    ),
+    'invalid_number': (
+        "Ты чё, братан, по пьяни печатаешь?\n"
+        "СН — это типа <code>AB123456</code>, без пробелов, без носков в клавиатуре.\n"
+        "Попробуй ещё раз, а то выкину в реку."
+    ),
+    'search_start': (
+        "🔍 Копаю в архивах... Где-то был этот <code>{number}</code>...\n"
+        "Если не спёрли, как в прошлый раз — найду."
+    ),
+    'search_start_multi': (
+        "🔍 Копаю в архивах... Где-то были эти СН: {numbers}..."
+    ),
+    'no_file': (
+        "Архивы пусты, брат.\n"
+        "Либо файл сожгли, либо его ещё не подкинули.\n"
+        "Приходи завтра — может, кто-нибудь не сдохнет и загрузит."
+    ),
+    'file_not_found_local': (
+        "Файл был, но теперь его нет.\n"
+        "Кто-то слил базу в канализацию или сервер сдох.\n"
+        "Жди, пока кто-то перезальёт."
+    ),
+    'no_terminal': (
+        "Терминал с СН <code>{number}</code>?\n"
+        "Нету. Ни в базе, ни в подвале, ни в багажнике 'Весты'.\n"
+        "Может, он уже в металлоломе... или ты втираешь мне очки?"
+    ),
+    'no_terminal_multi': (
+        "Терминалы с СН {numbers} не найдены."
+    ),
+    'too_many_numbers': (
+        "Ты мне весь склад сразу вывалил?\n"
+        "За раз — не больше {limit} СН. Разбей на несколько запросов."
+    ),
+    'file_update_error': (
+        "Файл обновился, но я не смог его подтянуть.\n"
+        "Работаю на старых данных — могут быть косяки."
+    ),
+    'file_update_success': (
+        "Файл обновился, но я не смог его загрузить.\n"
+        "Продолжаю работать на старых данных."
+    ),
+    'search_error': (
+        "База есть, но читать не могу — видимо, кто-то опять говнокод написал.\n"
+        "Попробуй позже."
+    ),
+    'result_send_error': (
+        "Нашёл терминал, но не могу показать — что-то сломалось.\n"
+        "Попробуй позже или скажи админу."
+    ),
+    'missing_number': (
+        "Укажи серийный номер после команды.\n"
+        "Пример: <code>/s AB123456</code>"
+    ),
+    'unknown_command': (
+        "Неизвестная команда.\n"
+        "Доступные команды:\n"
+        "• <code>/s 123456</code> — найти терминал по СН\n"
+        "• <code>/s 123456, 789012</code> — найти несколько терминалов по СН\n"  
+        "• <code>/ping</code> — проверить время отклика бота\n"
+        "• <code>@Sklad_bot 123456</code> — крикни в чатике, я найду\n"
+        "\n"
+        "<b>Только для админов:</b>\n"
+        "• <code>/whitelist show|add|remove [@username...]</code> — управление белым списком\n"
+        "• <code>/blacklist show|add|remove [@username...]</code> — управление чёрным списком\n"
+        "• <code>/path</code> — глянуть, что у нас в папке завалялось\n"
+        "• <code>/reload_lists</code> — обновить список предателей и своих\n"
+        "• <code>/restart</code> — перезапуск бота\n"
+        "• <code>/refresh</code> — обновления файла склада\n"
+        "• <code>/reset_bans</code> — сброс банов\n"
+    ),
+    'ddos_blocked': (
+        "Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
+        "Пожалуйста, подожди немного и попробуй снова."
+    ),
+    'ddos_blocked_minutes': (
+        "Стопэ! Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
+        "Абажди {minutes} минут и попробуй снова."
+    ),
+    'reset_success': (
+        "✅ Лимиты для пользователя <code>{username}</code> были сброшены."
+    ),
+    'reset_all_success': (
+        "✅ Все лимиты были сброшены."
+    ),
+    'reset_fail': (
+        "❌ Не удалось сбросить лимиты для пользователя <code>{username}</code>."
+    ),
+    'admin_only': (
+        "❌ Эта команда доступна только администраторам."
+    ),
+    'list_show_empty': (
+        "{list_type} список пуст."
+    ),
+    'list_show_header': (
+        "<b>{list_type} список ({count}):</b>\n<code>{usernames}</code>"
+    ),
+    'list_usage': (
+        "Использование:\n"
+        "<code>/{list_type} show</code> — показать список\n"
+        "<code>/{list_type} add @username1 @username2</code> — добавить пользователей\n"
+        "<code>/{list_type} remove @username1 @username2</code> — удалить пользователей"
+    ),
+    'list_no_usernames': (
+        "Укажите хотя бы один username."
+    ),
+    'list_invalid_usernames': (
+        "❌ Некорректные username: {usernames}\n"
+        "Username — от 3 до 32 символов: латиница, цифры и _."
+    ),
+    'list_no_write_permission': (
+        "❌ Недостаточно прав для записи в файл {list_type} на Google Drive. Изменения не сохранены."
+    ),
+    'list_update_success_add': (
+        "✅ {list_type} список обновлён.\n"
+        "Добавлены: {added}\n"
+        "Уже в списке: {already_in}"
+    ),
+    'list_update_success_remove': (
+        "✅ {list_type} список обновлён.\n"
+        "Удалены: {removed}\n"
+        "Не найдены в списке: {not_found}"
+    ),
+    'list_update_error': (
+        "❌ Ошибка при обновлении файла {list_type} на Google Drive. Изменения отменены."
+    ),
+    'list_unknown_action': (
+        "Неизвестное действие. Используйте <code>show</code>, <code>add</code> или <code>remove</code>."
+    )
+})
+
 def get_message(message_code: str, **kwargs) -> str:
     """
     Возвращает текст сообщения по коду с возможностью подстановки параметров.
@@ -647,199 +982,178 @@ def get_message(message_code: str, **kwargs) -> str:
     Returns:
         str: Форматированное сообщение
     """
-    messages = {
-        'access_denied': (
-            "Ты кто такой, дядя?\n"
-            "Не в списке — не входи.\n"
-            "Хочешь доступ — плати бабки или лежи в багажнике до утра."
-        ),
-        'help': (
-            "О, смотри-ка — гость на складе!\n"
-            "Только не стой как лох у контейнера — говори, что надо.\n"
-            "• <code>/s 123456</code> — найти терминал по СН\n"
-            "• <code>/s 123456, 789012</code> — найти несколько терминалов по СН\n"    
-            "• <code>/ping</code> — проверить время отклика бота\n"
-            "• <code>@Sklad_bot 123456</code> — крикни в чатике, я найду\n"
-            "\n"
-            "<b>Только для админов:</b>\n"
-            "• <code>/whitelist show|add|remove [@username...]</code> — управление белым списком\n"
-            "• <code>/blacklist show|add|remove [@username...]</code> — управление чёрным списком\n"
-            "• <code>/path</code> — глянуть, что у нас в папке завалялось\n"
-            "• <code>/reload_lists</code> — обновить список предателей и своих\n"
-            "• <code>/restart</code> — перезапуск бота\n"
-            "• <code>/refresh</code> — обновления файла склада\n"
-            "• <code>/reset_bans</code> — сброс банов\n"
-        ),
-        'invalid_number': (
-            "Ты чё, братан, по пьяни печатаешь?\n"
-            "СН — это типа <code>AB123456</code>, без пробелов, без носков в клавиатуре.\n"
-            "Попробуй ещё раз, а то выкину в реку."
-        ),
-        'search_start': (
-            "🔍 Копаю в архивах... Где-то был этот <code>{number}</code>...\n"
-            "Если не спёрли, как в прошлый раз — найду."
-        ),
-        'no_file': (
-            "Архивы пусты, брат.\n"
-            "Либо файл сожгли, либо его ещё не подкинули.\n"
-            "Приходи завтра — может, кто-нибудь не сдохнет и загрузит."
-        ),
-        'file_not_found_local': (
-            "Файл был, но теперь его нет.\n"
-            "Кто-то слил базу в канализацию или сервер сдох.\n"
-            "Жди, пока кто-то перезальёт."
-        ),
-        'no_terminal': (
-            "Терминал с СН <code>{number}</code>?\n"
-            "Нету. Ни в базе, ни в подвале, ни в багажнике 'Весты'.\n"
-            "Может, он уже в металлоломе... или ты втираешь мне очки?"
-        ),
-        'file_update_error': (
-            "Файл обновился, но я не смог его подтянуть.\n"
-            "Работаю на старых данных — могут быть косяки."
-        ),
-        'file_update_success': (
-            "Файл обновился, но я не смог его загрузить.\n"
-            "Продолжаю работать на старых данных."
-        ),
-        'search_error': (
-            "База есть, но читать не могу — видимо, кто-то опять говнокод написал.\n"
-            "Попробуй позже."
-        ),
-        'missing_number': (
-            "Укажи серийный номер после команды.\n"
-            "Пример: <code>/s AB123456</code>"
-        ),
-        'unknown_command': (
-            "Неизвестная команда.\n"
-            "Доступные команды:\n"
-            "• <code>/s 123456</code> — найти терминал по СН\n"
-            "• <code>/s 123456, 789012</code> — найти несколько терминалов по СН\n"  
-            "• <code>/ping</code> — проверить время отклика бота\n"
-            "• <code>@Sklad_bot 123456</code> — крикни в чатике, я найду\n"
-            "\n"
-            "<b>Только для админов:</b>\n"
-            "• <code>/whitelist show|add|remove [@username...]</code> — управление белым списком\n"
-            "• <code>/blacklist show|add|remove [@username...]</code> — управление чёрным списком\n"
-            "• <code>/path</code> — глянуть, что у нас в папке завалялось\n"
-            "• <code>/reload_lists</code> — обновить список предателей и своих\n"
-            "• <code>/restart</code> — перезапуск бота\n"
-            "• <code>/refresh</code> — обновления файла склада\n"
-            "• <code>/reset_bans</code> — сброс банов\n"
-        ),
-        'ddos_blocked': (
-            "Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
-            "Пожалуйста, подожди немного и попробуй снова."
-        ),
-        'reset_success': (
-            "✅ Лимиты для пользователя <code>{username}</code> были сброшены."
-        ),
-        'reset_all_success': (
-            "✅ Все лимиты были сброшены."
-        ),
-        'reset_fail': (
-            "❌ Не удалось сбросить лимиты для пользователя <code>{username}</code>."
-        ),
-        'admin_only': (
-            "❌ Эта команда доступна только администраторам."
-        ),
-        'list_show_empty': (
-            "{list_type} список пуст."
-        ),
-        'list_show_header': (
-            "<b>{list_type} список ({count}):</b>\n<code>{usernames}</code>"
-        ),
-        'list_usage': (
-            "Использование:\n"
-            "<code>/{list_type} show</code> — показать список\n"
-            "<code>/{list_type} add @username1 @username2</code> — добавить пользователей\n"
-            "<code>/{list_type} remove @username1 @username2</code> — удалить пользователей"
-        ),
-        'list_no_usernames': (
-            "Укажите хотя бы один username."
-        ),
-        'list_no_write_permission': (
-            "❌ Недостаточно прав для записи в файл {list_type} на Google Drive. Изменения не сохранены."
-        ),
-        'list_update_success_add': (
-            "✅ {list_type} список обновлён.\n"
-            "Добавлены: {added}\n"
-            "Уже в списке: {already_in}"
-        ),
-        'list_update_success_remove': (
-            "✅ {list_type} список обновлён.\n"
-            "Удалены: {removed}\n"
-            "Не найдены в списке: {not_found}"
-        ),
-        'list_update_error': (
-            "❌ Ошибка при обновлении файла {list_type} на Google Drive. Изменения отменены."
-        ),
-        'list_unknown_action': (
-            "Неизвестное действие. Используйте <code>show</code>, <code>add</code> или <code>remove</code>."
-        )
+    # Получаем шаблон по коду; без параметров возвращаем его как есть
+    message = _MESSAGES.get(message_code, "Неизвестное сообщение")
+    return message.format_map(kwargs) if kwargs else message
+
+def activate_warehouse_file(fm: 'FileManager', file_id: str, filename: str,
+                            target_date: datetime, drive_time: datetime) -> bool:
+    """
+    Скачивает найденный файл склада (если локальный кэш устарел)
+    и делает его текущим файлом для поиска.
+    Args:
+        fm (FileManager): Менеджер файлов Google Drive
+        file_id (str): ID файла в Google Drive
+        filename (str): Имя файла
+        target_date (datetime): Дата, за которую составлен файл
+        drive_time (datetime): Время изменения файла в Google Drive
+    Returns:
+        bool: True, если файл готов к использованию
+    """
+    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH, last_drive_check
+    # Формируем локальный путь
+    local_path = os.path.join(LOCAL_CACHE_DIR, f"cache_{target_date.strftime('%Y%m%d')}.xlsm")
+    # Проверяем, нуждается ли файл в обновлении
+    download_needed = True
+    if os.path.exists(local_path):
+        local_time = datetime.fromtimestamp(os.path.getmtime(local_path), tz=timezone.utc)
+        if drive_time <= local_time:
+            download_needed = False
+    # Скачиваем файл при необходимости
+    if download_needed:
+        logger.info(f"📥 Скачивание файла при старте: {filename} → {local_path}")
+        if not fm.download_file(file_id, local_path, modified_time=drive_time):
+            logger.error("❌ Не удалось скачать файл при старте.")
+            return False
+        logger.info(f"✅ Файл успешно загружен при старте: {local_path}")
+    else:
+        logger.info(f"✅ Используем существующий кэш: {local_path}")
+    # Сохраняем метаданные файла
+    LAST_FILE_ID = file_id
+    LAST_FILE_DATE = target_date
+    LAST_FILE_DRIVE_TIME = drive_time
+    LAST_FILE_LOCAL_PATH = local_path
+    last_drive_check = time.monotonic()
+    save_last_file_meta()
+    warm_sheet_index(local_path)
+    logger.info(f"📁 Предзагружен файл: {filename} (ID: {file_id}) от {target_date.strftime('%d.%m.%Y')}")
+    return True
+
+def warm_sheet_index(local_path: str):
+    """
+    Заранее строит (или загружает с диска) индекс СН для нового файла,
+    чтобы разбор Excel не ложился на первый поиск пользователя.
+    Args:
+        local_path (str): Путь к локальной копии файла склада
+    """
+    try:
+        LocalDataSearcher._get_sheet_index(local_path)
+    except Exception as e:
+        # Не критично: индекс будет построен при первом поиске
+        logger.warning(f"⚠️ Не удалось заранее построить индекс {local_path}: {e}")
+
+def save_last_file_meta():
+    """
+    Сохраняет метаданные текущего файла склада в LAST_FILE_META_PATH,
+    чтобы после перезапуска бот мог работать с ним без Google Drive.
+    """
+    meta = {
+        'file_id': LAST_FILE_ID,
+        'date': LAST_FILE_DATE.isoformat() if LAST_FILE_DATE else None,
+        'drive_time': LAST_FILE_DRIVE_TIME.isoformat() if LAST_FILE_DRIVE_TIME else None,
+        'local_path': LAST_FILE_LOCAL_PATH,
     }
-    # Получаем сообщение по коду и форматируем его с параметрами
-    message = messages.get(message_code, "Неизвестное сообщение")
-    return message.format(**kwargs) if kwargs else message
+    tmp_path = LAST_FILE_META_PATH + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(meta, fh)
+        # Атомарная замена, чтобы не оставить недописанный файл
+        os.replace(tmp_path, LAST_FILE_META_PATH)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось сохранить метаданные файла: {e}")
+
+def load_last_file_meta() -> bool:
+    """
+    Восстанавливает текущий файл склада из LAST_FILE_META_PATH,
+    если его локальная копия ещё на месте.
+    Returns:
+        bool: True, если файл восстановлен
+    """
+    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH
+    try:
+        with open(LAST_FILE_META_PATH, 'rb') as fh:
+            meta = json_loads(fh.read())
+        local_path = meta['local_path']
+        if not meta['file_id'] or not local_path or not os.path.exists(local_path):
+            return False
+        LAST_FILE_ID = meta['file_id']
+        LAST_FILE_DATE = datetime.fromisoformat(meta['date']) if meta['date'] else None
+        LAST_FILE_DRIVE_TIME = datetime.fromisoformat(meta['drive_time']) if meta['drive_time'] else None
+        LAST_FILE_LOCAL_PATH = local_path
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать метаданные файла: {e}")
+        return False
+    logger.warning(f"⚠️ Используем последний скачанный файл без проверки в Drive: {LAST_FILE_LOCAL_PATH}")
+    return True
 
 def preload_latest_file():
     """
     При старте бота ищет и загружает последний файл из архива.
     Ищет файл за последние 30 дней, начиная с сегодняшней даты.
+    Все файлы склада запрашиваются одним запросом к Drive API; обход
+    папок по дням используется только если этот запрос не удался.
     """
     global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH
-    gs = GoogleServices()
-    fm = FileManager(gs.drive)
+    fm = file_manager()
     today = datetime.now()
     logger.info("🔍 Поиск последнего файла при старте бота...")
-    # Проверяем файлы за последние 30 дней
-    for days_back in range(31):
-        target_date = today - timedelta(days=days_back)
-        filename = f"АПП_Склад_{target_date.strftime('%d%m%y')}_{CITY}.xlsm"
-        # Ищем папку "акты"
-        acts = fm.find_folder(PARENT_FOLDER_ID, "акты")
-        if not acts:
-            continue
-        # Формируем имя месяца
-        month_num = target_date.month
-        month_name = ["январь", "февраль", "март", "апрель", "май", "июнь",
-                      "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"][month_num - 1]
-        month_folder = fm.find_folder(acts, f"{target_date.strftime('%m')} - {month_name}")
-        if not month_folder:
-            continue
-        # Ищем папку с датой
-        date_folder = fm.find_folder(month_folder, target_date.strftime('%d%m%y'))
-        if not date_folder:
-            continue
-        # Ищем файл
-        file_id = fm.find_file(date_folder, filename)
-        if file_id:
-            drive_time = fm.get_file_modified_time(file_id)
-            if not drive_time:
+    files = fm.find_warehouse_files(CITY, modified_after=today - timedelta(days=31))
+    if files is not None:
+        # Кандидаты за последние 30 дней по дате в имени файла
+        candidates = []
+        for f in files:
+            match = WAREHOUSE_FILENAME_RE.match(f['name'])
+            if not match:
                 continue
-            # Формируем локальный путь
-            local_path = os.path.join(LOCAL_CACHE_DIR, f"cache_{target_date.strftime('%Y%m%d')}.xlsm")
-            # Проверяем, нуждается ли файл в обновлении
-            download_needed = True
-            if os.path.exists(local_path):
-                local_time = datetime.fromtimestamp(os.path.getmtime(local_path), tz=timezone.utc)
-                if drive_time <= local_time:
-                    download_needed = False
-            # Скачиваем файл при необходимости
-            if download_needed:
-                logger.info(f"📥 Скачивание файла при старте: {filename} → {local_path}")
-                if not fm.download_file(file_id, local_path):
-                    logger.error("❌ Не удалось скачать файл при старте.")
+            try:
+                # ДДММГГ: собираем дату из цифр напрямую, без разбора формата strptime
+                digits = match.group(1)
+                file_date = datetime(2000 + int(digits[4:]), int(digits[2:4]), int(digits[:2]))
+            except ValueError:
+                continue
+            if 0 <= (today - file_date).days <= 30:
+                candidates.append((file_date, f))
+        # От самого свежего к старым; если файл не удалось скачать — берём следующий
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        for file_date, f in candidates:
+            drive_time = fm.get_file_modified_time(f['id'], known_modified_time=f.get('modifiedTime'))
+            if drive_time and activate_warehouse_file(fm, f['id'], f['name'], file_date, drive_time):
+                return
+    else:
+        # Запасной вариант: обходим папки за последние 30 дней,
+        # запрашивая папки месяцев, дат и файлы пакетами, а не по одной
+        acts = fm.find_folder(PARENT_FOLDER_ID, "акты")
+        if acts:
+            target_dates = [today - timedelta(days=days_back) for days_back in range(31)]
+            # Имя папки месяца и даты (ДДММГГ) для каждого дня считаем один раз
+            month_labels = {d: f"{d.month:02d} - {MONTH_NAMES[d.month - 1]}" for d in target_dates}
+            date_names = {d: d.strftime('%d%m%y') for d in target_dates}
+            month_folders = fm.find_folders_bulk(acts, list(dict.fromkeys(month_labels.values())))
+            # Ищем папки с датами в каждой найденной папке месяца
+            date_folders: Dict[str, str] = {}
+            for label, month_folder in month_folders.items():
+                names = [date_names[d] for d in target_dates if month_labels[d] == label]
+                date_folders.update(fm.find_folders_bulk(month_folder, names))
+            # Файлы во всех папках дат ищем одним пакетным запросом,
+            # а проверяем от свежих к старым
+            days = [
+                (target_date, date_folders[date_names[target_date]],
+                 f"АПП_Склад_{date_names[target_date]}_{CITY}.xlsm")
+                for target_date in target_dates if date_names[target_date] in date_folders
+            ]
+            found_files = fm.find_files_in_folders([(folder_id, filename) for _, folder_id, filename in days])
+            for target_date, folder_id, filename in days:
+                f = found_files.get(folder_id)
+                if not f:
                     continue
-                logger.info(f"✅ Файл успешно загружен при старте: {local_path}")
-            else:
-                logger.info(f"✅ Используем существующий кэш: {local_path}")
-            # Сохраняем метаданные файла
-            LAST_FILE_ID = file_id
-            LAST_FILE_DATE = target_date
-            LAST_FILE_DRIVE_TIME = drive_time
-            LAST_FILE_LOCAL_PATH = local_path
-            logger.info(f"📁 Предзагружен файл: {filename} (ID: {file_id}) от {target_date.strftime('%d.%m.%Y')}")
+                # Время изменения пришло в том же ответе — отдельный запрос не нужен
+                drive_time = fm.get_file_modified_time(f['id'], known_modified_time=f.get('modifiedTime'))
+                if drive_time and activate_warehouse_file(fm, f['id'], filename, target_date, drive_time):
+                    return
+        # Drive недоступен — продолжаем работать с последним скачанным файлом
+        if load_last_file_meta():
             return
     # Если не нашли файл за 30 дней
     logger.warning("⚠️ Не удалось найти актуальный файл при старте.")
@@ -858,14 +1172,27 @@ def extract_number(query: str) -> Optional[str]:
     """
     if not query:
         return None
-    # Удаляем все пробелы и лишние символы
-    clean = re.sub(r'[^A-Za-z0-9\-]', '', query.strip())
-    # Проверяем, соответствует ли строка формату СН
-    if clean and re.fullmatch(r'[A-Za-z0-9\-]+', clean):
+    # Быстрый путь: обычный СН из латиницы и цифр не нуждается в очистке
+    if query.isascii() and query.isalnum():
+        return query.upper()
+    # Удаляем все пробелы и лишние символы; после этого строка
+    # состоит только из допустимых символов, отдельная проверка не нужна
+    clean = SN_INVALID_CHARS_RE.sub('', query)
+    if clean:
         return clean.upper()  # Приводим к верхнему регистру для единообразия
     return None
 
 # --- Обработчики команд ---
+def is_admin(user) -> bool:
+    """
+    Проверяет, является ли пользователь администратором бота.
+    Args:
+        user (User): Пользователь Telegram
+    Returns:
+        bool: True, если username пользователя есть в ALLOWED_USERS
+    """
+    return bool(user.username) and user.username.casefold() in ALLOWED_USERS_LC
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработчик команды /start.
@@ -878,7 +1205,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat_type = update.message.chat.type
     # Проверяем доступ в приватном чате
-    if chat_type == 'private' and (not user.username or user.username not in ALLOWED_USERS):
+    if chat_type == 'private' and not is_admin(user):
         await update.message.reply_text(get_message('access_denied'))
         return
     await update.message.reply_text(get_message('help'), parse_mode='HTML')
@@ -895,7 +1222,7 @@ async def restart_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user = update.effective_user
     # Проверяем, является ли пользователь администратором
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
+    if not is_admin(user):
         await update.message.reply_text("❌ Доступ запрещён.")
         return
     try:
@@ -923,28 +1250,27 @@ async def show_path(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     try:
-        gs = GoogleServices()
-        fm = FileManager(gs.drive)
+        fm = file_manager()
         root_id = PARENT_FOLDER_ID
-        items = fm.list_files_in_folder(root_id, max_results=100)
-        text = f"🗂 <b>Корневая папка</b> (ID: <code>{root_id}</code>)"
+        items = await run_drive_call(fm.list_files_in_folder, root_id, max_results=100)
+        lines = [f"🗂 <b>Корневая папка</b> (ID: <code>{root_id}</code>)", ""]
         # Формируем текст ответа
         if not items:
-            text += "Здесь даже паук не селится — пусто."
+            lines.append("Здесь даже паук не селится — пусто.")
         else:
             folders = [i for i in items if i['mimeType'] == 'application/vnd.google-apps.folder']
             files = [i for i in items if i['mimeType'] != 'application/vnd.google-apps.folder']
             if folders:
-                text += "<b>Подпапки:</b>"
+                lines.append("<b>Подпапки:</b>")
                 for f in sorted(folders, key=lambda x: x['name'].lower()):
-                    text += f"📁 <code>{f['name']}/</code>"
-                text += ""
+                    lines.append(f"📁 <code>{f['name']}/</code>")
+                lines.append("")
             if files:
-                text += "<b>Файлы:</b>"
+                lines.append("<b>Файлы:</b>")
                 for f in sorted(files, key=lambda x: x['name'].lower()):
                     size = f" ({f['size']} байт)" if f.get('size') else ""
-                    text += f"📄 <code>{f['name']}</code>{size}"
-        await update.message.reply_text(text, parse_mode='HTML')
+                    lines.append(f"📄 <code>{f['name']}</code>{size}")
+        await update.message.reply_text("\n".join(lines), parse_mode='HTML')
     except Exception as e:
         logger.error(f"❌ Ошибка /path: {e}")
         await update.message.reply_text(
@@ -962,14 +1288,14 @@ async def reload_lists(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user = update.effective_user
     # Проверяем, является ли пользователь администратором
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
+    if not is_admin(user):
         await update.message.reply_text("❌ Доступ запрещён.")
         return
     if not access_manager:
         await update.message.reply_text("❌ Система доступа не инициализирована.")
         return
     # Обновляем списки
-    access_manager.update_lists()
+    await access_manager.update_lists()
     await update.message.reply_text(
         f"✅ Списки успешно перезагружены.\n"
         f"Белый список: {len(access_manager.whitelist)} пользователей\n"
@@ -989,14 +1315,14 @@ async def reset_bans(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user = update.effective_user
     # Проверяем, является ли пользователь администратором
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
+    if not is_admin(user):
         await update.message.reply_text(get_message('admin_only'))
         return
     # Получаем параметры команды
     args = context.args
     if not args:
         await update.message.reply_text(
-            "Использование: /reset_bans <имя_пользователя или 'all'>"
+            "Использование: /reset_bans <имя_пользователя, ID или 'all'>"
         )
         return
     target = args[0].lower()
@@ -1004,7 +1330,7 @@ async def reset_bans(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Сбросить все лимиты
         user_activity.clear()
         banned_users.clear()
-        user_ban_start_times.clear()
+        user_ban_until.clear()
         user_ban_times.clear()
         await update.message.reply_text(get_message('reset_all_success'))
         logger.info(f"🔄 Администратор {user.username} сбросил все лимиты")
@@ -1018,6 +1344,16 @@ async def reset_bans(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"🔄 Администратор {user.username} сбросил лимиты для пользователя {username}")
 
 # --- Класс для работы с Google Drive файлами ---
+def escape_drive_literal(value: str) -> str:
+    """
+    Экранирует строку для подстановки в кавычки запроса Drive API (q=...).
+    Args:
+        value (str): Исходная строка
+    Returns:
+        str: Строка с экранированными обратными слэшами и апострофами
+    """
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
 class FileManager:
     """
     Класс для работы с файлами в Google Drive.
@@ -1041,85 +1377,173 @@ class FileManager:
             Optional[str]: ID найденной папки или None
         """
         # Формируем запрос к API Google Drive
-        query = f"mimeType='application/vnd.google-apps.folder' and name='{name}' and '{parent_id}' in parents and trashed=false"
+        query = f"mimeType='application/vnd.google-apps.folder' and name='{escape_drive_literal(name)}' and '{parent_id}' in parents and trashed=false"
         try:
-            res = self.drive.files().list(q=query, fields="files(id)").execute()
+            # Нужен только первый результат — не просим Drive собирать остальные
+            res = self.drive.files().list(q=query, fields="files(id)", pageSize=1).execute()
             folder_id = res['files'][0]['id'] if res['files'] else None
             if folder_id:
-                logger.info(f"🔍 Найдена папка: '{name}' (ID: {folder_id})")
+                logger.debug("🔍 Найдена папка: '%s' (ID: %s)", name, folder_id)
             else:
-                logger.debug(f"📁 Папка не найдена: '{name}' в родителе {parent_id}")
+                logger.debug("📁 Папка не найдена: '%s' в родителе %s", name, parent_id)
             return folder_id
         except Exception as e:
-            logger.error(f"❌ Ошибка поиска папки '{name}': {e}")
+            logger.error("❌ Ошибка поиска папки '%s': %s", name, e)
             return None
 
-    def find_file(self, folder_id: str, filename: str) -> Optional[str]:
+    def find_folders_bulk(self, parent_id: str, names: List[str]) -> Dict[str, str]:
         """
-        Ищет файл по имени в заданной папке.
+        Одним запросом ищет несколько папок по именам в заданной родительской папке.
         Args:
-            folder_id (str): ID папки
-            filename (str): Имя файла для поиска
+            parent_id (str): ID родительской папки
+            names (List[str]): Имена папок для поиска
         Returns:
-            Optional[str]: ID найденного файла или None
+            Dict[str, str]: Имя найденной папки -> её ID
         """
-        # Формируем запрос к API Google Drive
-        query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
+        if not names:
+            return {}
+        names_clause = " or ".join(f"name='{escape_drive_literal(n)}'" for n in names)
+        query = f"mimeType='application/vnd.google-apps.folder' and ({names_clause}) and '{parent_id}' in parents and trashed=false"
         try:
-            res = self.drive.files().list(q=query, fields="files(id)").execute()
-            file_id = res['files'][0]['id'] if res['files'] else None
-            if file_id:
-                logger.info(f"📎 Найден файл: '{filename}' (ID: {file_id})")
-            else:
-                logger.debug(f"📄 Файл не найден: '{filename}' в папке {folder_id}")
-            return file_id
+            res = self.drive.files().list(q=query, fields="files(id, name)", pageSize=1000).execute()
+            folders = {f['name']: f['id'] for f in res.get('files', [])}
+            logger.debug("🔍 Найдено папок: %d из %d в родителе %s", len(folders), len(names), parent_id)
+            return folders
         except Exception as e:
-            logger.error(f"❌ Ошибка поиска файла '{filename}': {e}")
+            logger.error("❌ Ошибка поиска папок %s в родителе %s: %s", names, parent_id, e)
+            return {}
+
+    def find_files_in_folders(self, lookups: List[Tuple[str, str]]) -> Dict[str, Dict]:
+        """
+        Ищет файлы по имени сразу в нескольких папках пакетным запросом к Drive API
+        (не больше 100 подзапросов на один HTTP-запрос).
+        Args:
+            lookups (List[Tuple[str, str]]): Пары (ID папки, имя файла)
+        Returns:
+            Dict[str, Dict]: ID папки -> найденный файл (id, modifiedTime)
+        """
+        found: Dict[str, Dict] = {}
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                logger.error("❌ Ошибка поиска файла в папке %s: %s", request_id, exception)
+                return
+            if response.get('files'):
+                found[request_id] = response['files'][0]
+
+        for start in range(0, len(lookups), 100):
+            try:
+                batch = self.drive.new_batch_http_request(callback=on_response)
+                for folder_id, filename in lookups[start:start + 100]:
+                    query = f"name='{escape_drive_literal(filename)}' and '{folder_id}' in parents and trashed=false"
+                    batch.add(self.drive.files().list(q=query, fields="files(id, modifiedTime)", pageSize=1), request_id=folder_id)
+                batch.execute()
+            except Exception as e:
+                logger.error("❌ Ошибка пакетного поиска файлов: %s", e)
+        logger.debug("📎 Найдено файлов: %d из %d", len(found), len(lookups))
+        return found
+
+    def find_warehouse_files(self, city: str, modified_after: Optional[datetime] = None) -> Optional[List[Dict]]:
+        """
+        Одним запросом ищет файлы склада вида АПП_Склад_ДДММГГ_<город>.xlsm
+        по всему доступному Drive (без обхода папок).
+        Args:
+            city (str): Город в имени файла
+            modified_after (Optional[datetime]): Искать только файлы, изменённые после этого времени
+        Returns:
+            Optional[List[Dict]]: Файлы (id, name, modifiedTime) или None при ошибке запроса
+        """
+        query = f"name contains 'АПП_Склад_' and name contains '_{escape_drive_literal(city)}.xlsm' and trashed=false"
+        if modified_after:
+            query += f" and modifiedTime > '{modified_after.strftime('%Y-%m-%dT%H:%M:%S')}'"
+        # Копии во временной папке не считаются архивом
+        if TEMP_FOLDER_ID:
+            query += f" and not '{TEMP_FOLDER_ID}' in parents"
+        files: List[Dict] = []
+        page_token = None
+        try:
+            while True:
+                res = self.drive.files().list(
+                    q=query,
+                    fields="nextPageToken, files(id, name, modifiedTime)",
+                    orderBy="modifiedTime desc",
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+                files.extend(res.get('files', []))
+                page_token = res.get('nextPageToken')
+                if not page_token:
+                    break
+            logger.info(f"🔍 Найдено файлов склада: {len(files)}")
+            return files
+        except Exception as e:
+            logger.error(f"❌ Ошибка поиска файлов склада: {e}")
             return None
 
-    def get_file_modified_time(self, file_id: str) -> Optional[datetime]:
+    def get_file_modified_time(self, file_id: str, known_modified_time: Optional[str] = None) -> Optional[datetime]:
         """
         Получает время модификации файла.
         Args:
             file_id (str): ID файла
+            known_modified_time (Optional[str]): Уже полученное поле modifiedTime
+                (например, из files.list) — тогда запрос к API не выполняется
         Returns:
             Optional[datetime]: Время модификации файла или None
         """
         try:
-            # Получаем информацию о файле
-            info = self.drive.files().get(fileId=file_id, fields="modifiedTime").execute()
-            t = info['modifiedTime']
-            # Преобразуем строку времени в объект datetime
-            dt = datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ")
-            # Применяем смещение часового пояса
-            dt_with_tz = dt.replace(tzinfo=timezone.utc) + timedelta(hours=TIMEZONE_OFFSET)
+            t = known_modified_time
+            if t is None:
+                # Получаем информацию о файле
+                info = self.drive.files().get(fileId=file_id, fields="modifiedTime").execute()
+                t = info['modifiedTime']
+            # Преобразуем строку RFC 3339 в datetime; 'Z' заменяем на смещение,
+            # которое fromisoformat понимает и в Python до 3.11
+            dt = datetime.fromisoformat(t.replace('Z', '+00:00'))
+            # Переводим в часовой пояс бота, не меняя сам момент времени,
+            # чтобы сравнение с mtime локального файла оставалось корректным
+            dt_with_tz = dt.astimezone(timezone(timedelta(hours=TIMEZONE_OFFSET)))
             return dt_with_tz
         except Exception as e:
             logger.error(f"❌ Ошибка получения времени файла {file_id}: {e}")
             return None
 
-    def download_file(self, file_id: str, local_path: str) -> bool:
+    def download_file(self, file_id: str, local_path: str, modified_time: Optional[datetime] = None) -> bool:
         """
         Скачивает файл из Google Drive в локальную директорию.
         Args:
             file_id (str): ID файла в Google Drive
             local_path (str): Локальный путь для сохранения файла
+            modified_time (Optional[datetime]): Время изменения файла в Drive;
+                записывается в mtime локальной копии, чтобы при следующем старте
+                неизменённый файл не скачивался повторно
         Returns:
             bool: True, если файл успешно скачан, False в противном случае
         """
+        # Скачиваем во временный файл рядом с целевым и атомарно подменяем его:
+        # потоки, которые в это время читают старую копию (сборка индекса),
+        # не увидят наполовину записанный файл
+        tmp_path = local_path + ".part"
         try:
             # Получаем медиа-поток файла
             request = self.drive.files().get_media(fileId=file_id)
-            with open(local_path, 'wb') as fh:
+            with open(tmp_path, 'wb') as fh:
                 downloader = MediaIoBaseDownload(fh, request)
                 done = False
                 # Скачиваем файл по частям
                 while not done:
                     status, done = downloader.next_chunk()
+            if modified_time is not None:
+                ts = modified_time.timestamp()
+                os.utime(tmp_path, (ts, ts))
+            os.replace(tmp_path, local_path)
             logger.info(f"✅ Файл успешно скачан: ID={file_id}, путь={local_path}")
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка при скачивании файла ID={file_id} в {local_path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
             return False
 
     def list_files_in_folder(self, folder_id: str, max_results: int = 100) -> List[Dict]:
@@ -1140,23 +1564,52 @@ class FileManager:
             logger.error(f"❌ Ошибка списка файлов в папке {folder_id}: {e}")
             return []
 
-    def check_write_permission(self, file_id: str) -> bool:
+    def check_write_permissions(self, file_ids: List[str]) -> Dict[str, bool]:
         """
-        Проверяет, есть ли у учетных данных бота права на редактирование файла.
+        Проверяет права на редактирование сразу нескольких файлов.
+        Непроверенные файлы запрашиваются одним пакетным запросом к Drive API,
+        успешные результаты кэшируются на WRITE_PERMISSION_TTL секунд.
         Args:
-            file_id (str): ID файла в Google Drive
+            file_ids (List[str]): Список ID файлов в Google Drive
         Returns:
-            bool: True, если есть права на запись, False в противном случае
+            Dict[str, bool]: Соответствие ID файла и наличия прав на запись
         """
+        now = time.monotonic()
+        results: Dict[str, bool] = {}
+        pending = []
+        # Берём из кэша ещё не устаревшие результаты
+        for file_id in dict.fromkeys(file_ids):
+            cached = write_permission_cache.get(file_id)
+            if cached and now - cached[0] < WRITE_PERMISSION_TTL:
+                results[file_id] = cached[1]
+            else:
+                pending.append(file_id)
+        if not pending:
+            return results
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"❌ Ошибка проверки прав на запись для файла {request_id}: {exception}")
+                results[request_id] = False
+                return
+            can_edit = response.get('capabilities', {}).get('canEdit', False)
+            # Метаданные приходят в том же ответе — запоминаем их для update_list_file
+            list_file_meta_cache[request_id] = (response.get('mimeType', 'text/plain'), response.get('name', 'list.txt'))
+            logger.debug(f"Проверка прав на запись для файла {request_id}: canEdit={can_edit}")
+            results[request_id] = can_edit
+            write_permission_cache[request_id] = (now, can_edit)
+
         try:
-            # Получаем информацию о файле, включая разрешения
-            info = self.drive.files().get(fileId=file_id, fields="capabilities/canEdit, permissions").execute()
-            can_edit = info.get('capabilities', {}).get('canEdit', False)
-            logger.debug(f"Проверка прав на запись для файла {file_id}: canEdit={can_edit}")
-            return can_edit
+            # Все запросы уходят в Drive одним HTTP-запросом
+            batch = self.drive.new_batch_http_request(callback=on_response)
+            for file_id in pending:
+                batch.add(self.drive.files().get(fileId=file_id, fields="mimeType, name, capabilities/canEdit"), request_id=file_id)
+            batch.execute()
         except Exception as e:
-            logger.error(f"❌ Ошибка проверки прав на запись для файла {file_id}: {e}")
-            return False
+            logger.error(f"❌ Ошибка пакетной проверки прав на запись для файлов {pending}: {e}")
+        for file_id in pending:
+            results.setdefault(file_id, False)
+        return results
 
     def update_list_file(self, file_id: str, usernames: List[str]) -> bool:
         """
@@ -1168,14 +1621,19 @@ class FileManager:
             bool: True, если успешно, False в противном случае
         """
         try:
-            # 1. Сначала получаем метаданные файла, чтобы узнать его MIME-тип
-            file_metadata = self.drive.files().get(fileId=file_id, fields="mimeType, name").execute()
-            mime_type = file_metadata.get('mimeType', 'text/plain')
-            filename = file_metadata.get('name', 'list.txt')
+            # 1. Узнаём MIME-тип файла (обычно уже известен после проверки прав)
+            meta = list_file_meta_cache.get(file_id)
+            if meta is None:
+                file_metadata = self.drive.files().get(fileId=file_id, fields="mimeType, name").execute()
+                meta = (file_metadata.get('mimeType', 'text/plain'), file_metadata.get('name', 'list.txt'))
+                list_file_meta_cache[file_id] = meta
+            mime_type, filename = meta
 
             # 2. Создаем новый контент
             content = "\n".join([f"@{u}" for u in usernames]) + "\n" # Каждый юзер с новой строки, с @
-            media_body = MediaIoBaseUpload(io.BytesIO(content.encode('utf-8')), mimetype=mime_type, resumable=True)
+            # Файл маленький: простая multipart-загрузка обходится одним запросом,
+            # а resumable-загрузка требует отдельного запроса на создание сессии
+            media_body = MediaIoBaseUpload(io.BytesIO(content.encode('utf-8')), mimetype=mime_type, resumable=False)
 
             # 3. Обновляем файл
             updated_file = self.drive.files().update(
@@ -1189,114 +1647,293 @@ class FileManager:
             logger.error(f"❌ Ошибка обновления файла списка {file_id}: {e}")
             return False
 
+@functools.cache
+def file_manager() -> FileManager:
+    """
+    Возвращает общий для всех обработчиков менеджер файлов Google Drive.
+    Returns:
+        FileManager: Менеджер файлов поверх drive_service()
+    """
+    return FileManager(drive_service())
+
+def reset_google_clients():
+    """
+    Сбрасывает закэшированные клиенты Google Drive (например, после смены
+    учетных данных); при следующем обращении они будут созданы заново.
+    """
+    file_manager.cache_clear()
+    drive_service.cache_clear()
+
 # --- Класс для поиска данных в Excel ---
+# Диапазон столбцов листа "Терминалы", нужных для индекса и карточки: E..Q
+# (индексы с нуля, правая граница не включается). Остальные столбцы
+# при чтении листа не разбираются и не хранятся в индексе
+TERMINAL_FIRST_COLUMN = 4
+TERMINAL_COLUMNS = 17
+# Индекс СН (столбец F) в прочитанной строке, т.е. относительно столбца E
+TERMINAL_SN_FIELD = 1
+# Столбцы для карточки терминала: (индекс относительно столбца E, значение по умолчанию)
+# Порядок: тип оборудования (E), модель (G), заявка (H), статус (I), место на складе (N),
+# статус выдачи (O), инженер (P), дата выдачи (Q)
+TERMINAL_FIELDS = (
+    (0, "Не указано"),
+    (2, "Не указано"),
+    (3, "Не указано"),
+    (4, "Не указано"),
+    (9, "Не указано"),
+    (10, ""),
+    (11, "Не указано"),
+    (12, "Не указано"),
+)
+# Статусы неисправного оборудования (в нижнем регистре)
+BROKEN_STATUSES = frozenset({"не работоспособно", "выведено из эксплуатации"})
+# Версия формата сохранённого индекса: при смене набора столбцов старые .idx.pkl не используются
+INDEX_FORMAT_VERSION = 2
+
+def cell_text(value) -> str:
+    """
+    Приводит значение ячейки Excel к строке.
+    calamine возвращает числа как float, поэтому целые числа
+    выводятся без '.0' — так же, как их отдаёт openpyxl.
+    Args:
+        value: Значение ячейки
+    Returns:
+        str: Текст ячейки без пробелов по краям
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
 class LocalDataSearcher:
     """
     Класс для поиска данных в локальных Excel файлах.
     Предоставляет методы для асинхронного поиска по серийным номерам.
     """
     @staticmethod
-    async def search_by_number_async(filepath: str, number: str) -> List[str]:
+    async def search_by_numbers_async(filepath: str, numbers: List[str]) -> List[str]:
         """
-        Асинхронный поиск терминала по серийному номеру в Excel файле.
+        Асинхронный поиск нескольких терминалов за одно обращение к файлу.
         Args:
             filepath (str): Путь к Excel файлу
-            number (str): Серийный номер для поиска
+            numbers (List[str]): Серийные номера для поиска
         Returns:
-            List[str]: Список результатов поиска
+            List[str]: Результаты поиска в порядке номеров
         """
-        loop = asyncio.get_event_loop()
-        # Выполняем синхронную операцию в пуле потоков
-        return await loop.run_in_executor(executor, LocalDataSearcher._search_by_number_sync, filepath, number)
+        try:
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            mtime = None
+        # Одинаковые одновременные запросы к одной версии файла ждут одну задачу
+        key = (filepath, mtime, tuple(numbers))
+        future = search_inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            # Все номера обрабатываются одной задачей в пуле потоков
+            future = loop.run_in_executor(executor, LocalDataSearcher._search_by_numbers_sync, filepath, numbers)
+            search_inflight[key] = future
+            future.add_done_callback(lambda _: search_inflight.pop(key, None))
+        # shield: отмена одного ожидающего не должна отменять общий поиск
+        return await asyncio.shield(future)
     @staticmethod
-
-    def _search_by_number_sync(filepath: str, number: str) -> List[str]:
+    def _get_sheet_index(filepath: str) -> Dict[str, List[tuple]]:
         """
-        Синхронная реализация поиска терминала по серийному номеру.
+        Возвращает индекс листа "Терминалы" по серийным номерам.
+        Индекс строится один раз и пересобирается при изменении mtime файла.
         Args:
             filepath (str): Путь к Excel файлу
-            number (str): Серийный номер для поиска
         Returns:
-            List[str]: Список результатов поиска
+            Dict[str, List[tuple]]: СН в верхнем регистре -> строки листа
         """
-        number_upper = number.strip().upper()
-        results = []
+        mtime = os.path.getmtime(filepath)
+        cached = sheet_index_cache.get(filepath)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        # Разбор Excel упирается в GIL: параллельные сборки в нескольких потоках
+        # не ускоряются, а только дублируют работу. Строим индекс в одном потоке,
+        # остальные поиски ждут и получают готовый результат
+        with sheet_index_lock:
+            cached = sheet_index_cache.get(filepath)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            # После перезапуска индекс берётся с диска, если файл не менялся
+            index = LocalDataSearcher._load_index_sidecar(filepath, mtime)
+            if index is None:
+                index = LocalDataSearcher._build_sheet_index(filepath)
+                LocalDataSearcher._save_index_sidecar(filepath, mtime, index)
+            # Храним индекс только актуального файла
+            sheet_index_cache.clear()
+            sheet_index_cache[filepath] = (mtime, index)
+            return index
+    @staticmethod
+    def _load_index_sidecar(filepath: str, mtime: float) -> Optional[Dict[str, List[tuple]]]:
+        """
+        Загружает сохранённый индекс из файла <filepath>.idx.pkl.
+        Args:
+            filepath (str): Путь к Excel файлу
+            mtime (float): Текущее время изменения Excel файла
+        Returns:
+            Optional[Dict[str, List[tuple]]]: Индекс или None, если его нет или он устарел
+        """
+        sidecar = filepath + INDEX_SIDECAR_SUFFIX
+        try:
+            with open(sidecar, 'rb') as fh:
+                data = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать сохранённый индекс {sidecar}: {e}")
+            return None
+        if data.get('version') != INDEX_FORMAT_VERSION or data.get('mtime') != mtime:
+            return None
+        logger.info(f"📑 Индекс {filepath} загружен с диска: {len(data['index'])} СН")
+        # pickle не сохраняет интернирование — интернируем ключи заново
+        return {sys.intern(k): v for k, v in data['index'].items()}
+    @staticmethod
+    def _save_index_sidecar(filepath: str, mtime: float, index: Dict[str, List[tuple]]):
+        """
+        Сохраняет индекс рядом с Excel файлом для быстрого старта после перезапуска.
+        Args:
+            filepath (str): Путь к Excel файлу
+            mtime (float): Время изменения Excel файла, по которому строился индекс
+            index (Dict[str, List[tuple]]): Индекс листа
+        """
+        sidecar = filepath + INDEX_SIDECAR_SUFFIX
+        tmp_path = sidecar + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as fh:
+                pickle.dump({'version': INDEX_FORMAT_VERSION, 'mtime': mtime, 'index': index}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            # Атомарная замена, чтобы не оставить недописанный индекс
+            os.replace(tmp_path, sidecar)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить индекс {sidecar}: {e}")
+    @staticmethod
+    def _iter_sheet_rows(filepath: str) -> Iterator[tuple]:
+        """
+        Построчно читает лист "Терминалы" без строки заголовка,
+        только столбцы с TERMINAL_FIRST_COLUMN по TERMINAL_COLUMNS (E..Q).
+        Если установлен python-calamine, используется он, иначе openpyxl.
+        Args:
+            filepath (str): Путь к Excel файлу
+        Returns:
+            Iterator[tuple]: Значения ячеек строк, начиная со столбца E (TERMINAL_FIRST_COLUMN)
+        """
+        if CalamineWorkbook is not None:
+            wb = CalamineWorkbook.from_path(filepath)
+            if "Терминалы" not in wb.sheet_names:
+                logger.warning(f"⚠️ Лист 'Терминалы' не найден в {filepath}")
+                return
+            # skip_empty_area=False сохраняет индексы столбцов, как у openpyxl
+            rows = wb.get_sheet_by_name("Терминалы").to_python(skip_empty_area=False)
+            if len(rows) < 2:
+                logger.warning(f"⚠️ Файл {filepath} пуст или не содержит данных")
+                return
+            # В индексе храним только нужные столбцы
+            for row in rows[1:]:
+                yield row[TERMINAL_FIRST_COLUMN:TERMINAL_COLUMNS]
+            return
+        wb = openpyxl.load_workbook(filepath, read_only=True, data_only=True, keep_vba=False, keep_links=False)
         try:
-            # Логирование запроса
-            logger.info(f"🔍 Поиск терминала по СН: {number_upper}")
-            # Проверка существования файла
-            if not os.path.exists(filepath):
-                logger.error(f"❌ Файл не существует: {filepath}")
-                return results
-            # Открываем Excel файл
-            wb = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
             sheet = wb["Терминалы"] if "Терминалы" in wb.sheetnames else None
             if not sheet:
                 logger.warning(f"⚠️ Лист 'Терминалы' не найден в {filepath}")
-                wb.close()
-                return results
+                return
             # Проверка наличия данных в файле
             if sheet.max_row < 2:
                 logger.warning(f"⚠️ Файл {filepath} пуст или не содержит данных")
-                wb.close()
+                return
+            yield from sheet.iter_rows(min_row=2, min_col=TERMINAL_FIRST_COLUMN + 1,
+                                      max_col=TERMINAL_COLUMNS, values_only=True)
+        finally:
+            wb.close()
+    @staticmethod
+    def _build_sheet_index(filepath: str) -> Dict[str, List[tuple]]:
+        """
+        Читает лист "Терминалы" и строит индекс по серийным номерам.
+        Args:
+            filepath (str): Путь к Excel файлу
+        Returns:
+            Dict[str, List[tuple]]: СН в верхнем регистре -> строки листа
+        """
+        start = time.monotonic()
+        index: Dict[str, List[tuple]] = {}
+        # Проходим по строкам таблицы
+        for row in LocalDataSearcher._iter_sheet_rows(filepath):
+            if len(row) < TERMINAL_COLUMNS - TERMINAL_FIRST_COLUMN or not row[TERMINAL_SN_FIELD]:
+                continue
+            # Строка сохраняется как есть: поля приводятся к строкам
+            # только для найденных записей, а не для всего листа
+            # Ключи интернируются: запрос ищется тоже интернированной строкой,
+            # и словарь находит ключ по совпадению объекта без сравнения строк
+            index.setdefault(sys.intern(cell_text(row[TERMINAL_SN_FIELD]).upper()), []).append(row)
+        logger.info(f"📑 Индекс {filepath} построен: {len(index)} СН за {time.monotonic() - start:.2f} с")
+        return index
+    @staticmethod
+    def _search_by_numbers_sync(filepath: str, numbers: List[str]) -> List[str]:
+        """
+        Синхронная реализация поиска терминалов по нескольким серийным номерам.
+        Индекс файла получается один раз на весь запрос.
+        Args:
+            filepath (str): Путь к Excel файлу
+            numbers (List[str]): Серийные номера для поиска
+        Returns:
+            List[str]: Список результатов поиска
+        """
+        results = []
+        try:
+            # Отсутствие файла обнаружит stat внутри _get_sheet_index
+            try:
+                index = LocalDataSearcher._get_sheet_index(filepath)
+            except FileNotFoundError:
+                logger.error(f"❌ Файл не существует: {filepath}")
                 return results
-            found = False
-            # Проходим по строкам таблицы
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                if len(row) < 17 or not row[5]:  # СН в столбце F (индекс 5)
-                    continue
-                # Извлечение данных
-                sn = str(row[5]).strip().upper()
-                if sn != number_upper:
-                    continue
-                found = True
-                equipment_type = str(row[4]).strip() if row[4] else "Не указано"
-                model = str(row[6]).strip() if row[6] else "Не указано"
-                request_num = str(row[7]).strip() if row[7] else "Не указано"
-                status = str(row[8]).strip() if row[8] else "Не указано"
-                storage = str(row[13]).strip() if row[13] else "Не указано"
-                issue_status = str(row[14]).strip() if row[14] else ""
-                engineer = str(row[15]).strip() if row[15] else "Не указано"
-                issue_date = str(row[16]).strip() if row[16] else "Не указано"
-                # Регистронезависимые проверки
-                status_lower = status.lower()
-                issue_status_lower = issue_status.lower()
-                # Формируем базовые поля
-                response_parts = [
-                    f"<b>СН:</b> <code>{sn}</code>\n",
-                    f"<b>Тип оборудования:</b> <code>{equipment_type}</code>\n",
-                    f"<b>Модель терминала:</b> <code>{model}</code>\n",
-                ]
-                # --- Логика по статусу ---
-                if status_lower == "на складе":
-                    response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>\n")
-                    response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code>\n")
-                elif status_lower in ["не работоспособно", "выведено из эксплуатации"]:
-                    response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code> — как труп в багажнике\n")
-                    response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code> — можно разобрать на запчасти\n")
-                elif status_lower == "зарезервировано":
-                    response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>\n")
-                    response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code>\n")
-                    if issue_status_lower == "выдан":
-                        # Показываем всё: место, инженера, дату
-                        response_parts.append(f"<b>Заявка:</b> <code>{request_num}</code>\n")
-                        response_parts.append(f"<b>Выдан инженеру:</b> <code>{engineer}</code>\n")
-                        response_parts.append(f"<b>Дата выдачи:</b> <code>{issue_date}</code>\n")
-                    # Если не выдан — ничего больше не добавляем
+            # Повторяющиеся номера ищем один раз
+            for number_upper in dict.fromkeys(sys.intern(n.strip().upper()) for n in numbers):
+                # Логирование запроса
+                logger.info(f"🔍 Поиск терминала по СН: {number_upper}")
+                records = index.get(number_upper, ())
+                for row in records:
+                    # Извлечение данных
+                    sn = number_upper
+                    (equipment_type, model, request_num, status,
+                     storage, issue_status, engineer, issue_date) = [
+                        cell_text(row[i]) if row[i] else default for i, default in TERMINAL_FIELDS
+                    ]
+                    # Регистронезависимая проверка статуса
+                    status_lower = status.lower()
+                    # Формируем базовые поля
+                    response_parts = [
+                        f"<b>СН:</b> <code>{sn}</code>",
+                        f"<b>Тип оборудования:</b> <code>{equipment_type}</code>",
+                        f"<b>Модель терминала:</b> <code>{model}</code>",
+                    ]
+                    # --- Логика по статусу ---
+                    if status_lower == "на складе":
+                        response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>")
+                        response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code>")
+                    elif status_lower in BROKEN_STATUSES:
+                        response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code> — как труп в багажнике")
+                        response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code> — можно разобрать на запчасти")
+                    elif status_lower == "зарезервировано":
+                        response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>")
+                        response_parts.append(f"<b>Место на складе:</b> <code>{storage}</code>")
+                        if issue_status.lower() == "выдан":
+                            # Показываем всё: место, инженера, дату
+                            response_parts.append(f"<b>Заявка:</b> <code>{request_num}</code>")
+                            response_parts.append(f"<b>Выдан инженеру:</b> <code>{engineer}</code>")
+                            response_parts.append(f"<b>Дата выдачи:</b> <code>{issue_date}</code>")
+                        # Если не выдан — ничего больше не добавляем
+                    else:
+                        # Все остальные статусы: просто показываем статус
+                        response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>")
+                        # Можно добавить место, если нужно, но по ТЗ — не требуется
+                    # Формируем итоговый текст
+                    result_text = "ℹ️ <b>Информация о терминале</b>\n" + "\n".join(response_parts)
+                    results.append(result_text)
+                # Логирование результата поиска
+                if records:
+                    logger.info(f"✅ Найден терминал по СН: {number_upper}")
                 else:
-                    # Все остальные статусы: просто показываем статус
-                    response_parts.append(f"<b>Статус оборудования:</b> <code>{status}</code>\n")
-                    # Можно добавить место, если нужно, но по ТЗ — не требуется
-                # Формируем итоговый текст
-                header = "ℹ️ <b>Информация о терминале</b>\n"
-                result_text = header + "" + "".join(response_parts)
-                results.append(result_text)
-            wb.close()
-            # Логирование результата поиска
-            if found:
-                logger.info(f"✅ Найден терминал по СН: {number_upper}")
-            else:
-                logger.info(f"❌ Терминал не найден по СН: {number_upper}")
+                    logger.info(f"❌ Терминал не найден по СН: {number_upper}")
         except openpyxl.utils.exceptions.InvalidFileException as e:
             logger.error(f"❌ Ошибка чтения Excel (поврежденный файл): {filepath} - {e}")
         except openpyxl.utils.exceptions.IllegalCharacterError as e:
@@ -1305,49 +1942,102 @@ class LocalDataSearcher:
             logger.error(f"❌ Неожиданная ошибка при чтении Excel {filepath}: {e}", exc_info=True)
         return results
 
-async def handle_search(update: Update, query: str, user=None, username=None):
+def split_long_part(part: str, limit: int) -> List[str]:
+    """
+    Делит слишком длинную часть ответа на куски не длиннее limit по границам строк,
+    чтобы не разрезать HTML-теги посреди строки. Обрезается только строка,
+    которая сама по себе длиннее лимита.
+    Args:
+        part (str): Часть ответа
+        limit (int): Максимальная длина куска
+    Returns:
+        List[str]: Куски части ответа
+    """
+    chunks = []
+    buf: List[str] = []
+    size = 0
+    for line in part.split("\n"):
+        if len(line) > limit:
+            line = line[:limit - len(TRUNCATED_SUFFIX)] + TRUNCATED_SUFFIX
+        if buf and size + 1 + len(line) > limit:
+            chunks.append("\n".join(buf))
+            buf, size = [], 0
+        size += len(line) + (1 if buf else 0)
+        buf.append(line)
+    if buf:
+        chunks.append("\n".join(buf))
+    return chunks
+
+async def safe_reply(message, text: str, fallback: Optional[str] = None, **kwargs) -> bool:
+    """
+    Отправляет ответ, не пробрасывая ошибки Telegram наружу.
+    Повторы после RetryAfter (429) выполняет AIORateLimiter приложения.
+    Args:
+        message (Message): Сообщение, на которое отвечаем
+        text (str): Текст ответа
+        fallback (Optional[str]): Запасной текст без разметки, если ответ не ушёл
+        **kwargs: Параметры reply_text (например, parse_mode)
+    Returns:
+        bool: True, если основной ответ отправлен
+    """
+    try:
+        await message.reply_text(text, **kwargs)
+        return True
+    except Exception as e:
+        logger.error("❌ Ошибка отправки сообщения: %s", e)
+    if fallback is not None:
+        try:
+            await message.reply_text(fallback)
+        except Exception as e:
+            logger.error("❌ Ошибка отправки запасного сообщения: %s", e)
+    return False
+
+def pack_messages(parts: List[str], limit: int = TELEGRAM_MESSAGE_LIMIT, sep: str = "\n\n") -> List[str]:
+    """
+    Склеивает части ответа в как можно меньшее число сообщений не длиннее limit.
+    Часть, которая сама длиннее лимита, делится по строкам (split_long_part).
+    Args:
+        parts (List[str]): Части ответа (например, карточки терминалов)
+        limit (int): Максимальная длина одного сообщения
+        sep (str): Разделитель между частями внутри сообщения
+    Returns:
+        List[str]: Готовые к отправке сообщения
+    """
+    messages = []
+    buf: List[str] = []
+    size = 0
+    for part in parts:
+        for piece in (split_long_part(part, limit) if len(part) > limit else (part,)):
+            # Новая часть не помещается — отправляем накопленное отдельным сообщением
+            if buf and size + len(sep) + len(piece) > limit:
+                messages.append(sep.join(buf))
+                buf, size = [], 0
+            size += len(piece) + (len(sep) if buf else 0)
+            buf.append(piece)
+    if buf:
+        messages.append(sep.join(buf))
+    return messages
+
+async def handle_search(update: Update, query: str, user=None):
     """
     Общая логика поиска терминала по серийному номеру.
     Args:
         update (Update): Объект обновления от Telegram
         query (str): Запрос пользователя
         user (User, optional): Объект пользователя (если известен)
-        username (str, optional): Username пользователя (если известен)
     """
     # Определяем пользователя, если не передан
     if user is None:
         user = update.effective_user
-    if username is None:
-        username = user.username if user.username else str(user.id)
 
     # Проверяем доступ в приватном чате
     if update.message.chat.type == 'private':
-        if not user.username or not access_manager.is_allowed(user.username.lower()):
+        if not user.username or not access_manager.is_allowed(user.username):
             await update.message.reply_text(
                 get_message('access_denied')
             )
             return
 
-    # Проверяем лимиты DDoS
-    if not check_user_limit(username):
-        # Получаем время до разблокировки
-        ban_start = user_ban_start_times.get(username)
-        ban_time = user_ban_times.get(username, 10)
-        if ban_start:
-            remaining_time = ban_start + timedelta(minutes=ban_time) - (datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET))
-            minutes_left = int(remaining_time.total_seconds() // 60)
-            await update.message.reply_text(
-                f"Стопэ! Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
-                f"Абажди {minutes_left} минут и попробуй снова.",
-                parse_mode='HTML'
-            )
-        else:
-            await update.message.reply_text(
-                get_message('ddos_blocked'),
-                parse_mode='HTML'
-            )
-        return
-
     # Извлекаем серийные номера (разделенные запятой)
     numbers = [extract_number(num_str) for num_str in query.split(',')]
     numbers = [num for num in numbers if num]  # Убираем пустые значения
@@ -1357,96 +2047,77 @@ async def handle_search(update: Update, query: str, user=None, username=None):
             parse_mode='HTML'
         )
         return
+    # Ограничиваем размер запроса: длинные списки номеров отклоняем сразу
+    if len(numbers) > MAX_NUMBERS_PER_QUERY:
+        await safe_reply(update.message, get_message('too_many_numbers', limit=MAX_NUMBERS_PER_QUERY))
+        return
 
     # Отправляем промежуточное сообщение только один раз
-    try:
-        if len(numbers) == 1:
-            await update.message.reply_text(
-                get_message('search_start', number=numbers[0]),
-                parse_mode='HTML'
-            )
-        else:
-            await update.message.reply_text(
-                f"🔍 Копаю в архивах... Где-то были эти СН: {', '.join(numbers)}...",
-                parse_mode='HTML'
-            )
-    except Exception as e:
-        logger.error(f"❌ Не удалось отправить статус-сообщение: {e}")
+    if len(numbers) == 1:
+        status_text = get_message('search_start', number=numbers[0])
+    else:
+        status_text = get_message('search_start_multi', numbers=', '.join(numbers))
+    if not await safe_reply(update.message, status_text, parse_mode='HTML'):
         return
 
-    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH
+    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH, last_drive_check
     # Проверка: есть ли загруженный файл
     if not LAST_FILE_ID or not LAST_FILE_LOCAL_PATH:
         logger.warning("❌ Нет данных: файл не был предзагружен при старте.")
-        try:
-            await update.message.reply_text(
-                get_message('no_file')
-            )
-        except Exception as e:
-            logger.error(f"❌ Не удалось отправить ответ об отсутствии файла: {e}")
+        await safe_reply(update.message, get_message('no_file'))
         return
-    if not os.path.exists(LAST_FILE_LOCAL_PATH):
-        logger.warning(f"❌ Локальный файл не найден: {LAST_FILE_LOCAL_PATH}")
-        try:
-            await update.message.reply_text(
-                get_message('file_not_found_local')
-            )
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки сообщения: {e}")
+    # Проверяем, что локальная копия на месте (один stat)
+    try:
+        os.stat(LAST_FILE_LOCAL_PATH)
+    except FileNotFoundError:
+        logger.warning("❌ Локальный файл не найден: %s", LAST_FILE_LOCAL_PATH)
+        await safe_reply(update.message, get_message('file_not_found_local'))
         return
 
-    # Получаем актуальное время файла в Google Drive
-    try:
-        gs = GoogleServices()
-        fm = FileManager(gs.drive)
-        current_drive_time = fm.get_file_modified_time(LAST_FILE_ID)
-        if not current_drive_time:
-            logger.warning(f"⚠️ Не удалось получить время изменения файла: {LAST_FILE_ID}")
-            # Продолжаем с кэшированным временем
-        else:
-            # Проверяем, нужно ли обновить
-            local_time = datetime.fromtimestamp(os.path.getmtime(LAST_FILE_LOCAL_PATH), tz=timezone.utc)
-            if LAST_FILE_DRIVE_TIME is None or current_drive_time > LAST_FILE_DRIVE_TIME:
-                logger.info(f"🔄 Файл в облаке новее ({current_drive_time.isoformat()} > {LAST_FILE_DRIVE_TIME}). Скачивание...")
-                try:
-                    if fm.download_file(LAST_FILE_ID, LAST_FILE_LOCAL_PATH):
-                        LAST_FILE_DRIVE_TIME = current_drive_time
-                        logger.info(f"✅ Файл обновлён: {LAST_FILE_LOCAL_PATH}")
-                    else:
-                        logger.error("❌ Не удалось скачать обновлённый файл. Используем старую версию.")
-                        try:
-                            await update.message.reply_text(
-                                get_message('file_update_error')
-                            )
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка отправки предупреждения: {e}")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при скачивании файла: {e}", exc_info=True)
-                    try:
-                        await update.message.reply_text(
-                            get_message('file_update_success')
-                        )
-                    except Exception as e_inner:
-                        logger.error(f"❌ Ошибка отправки уведомления: {e_inner}")
-    except Exception as e:
-        logger.error(f"❌ Критическая ошибка при проверке обновления файла: {e}", exc_info=True)
+    # Получаем актуальное время файла в Google Drive, но не чаще раза
+    # в DRIVE_MTIME_TTL секунд: остальные поиски обходятся без запросов к Drive
+    if time.monotonic() - last_drive_check >= DRIVE_MTIME_TTL:
+        last_drive_check = time.monotonic()
         try:
-            await update.message.reply_text(
-                get_message('search_error')
-            )
-        except Exception as e_inner:
-            logger.error(f"❌ Ошибка отправки сообщения: {e_inner}")
+            fm = file_manager()
+            current_drive_time = await run_drive_call(fm.get_file_modified_time, LAST_FILE_ID)
+            if not current_drive_time:
+                logger.warning("⚠️ Не удалось получить время изменения файла: %s", LAST_FILE_ID)
+                # Продолжаем с кэшированным временем
+            else:
+                # Проверяем, нужно ли обновить
+                if LAST_FILE_DRIVE_TIME is None or current_drive_time > LAST_FILE_DRIVE_TIME:
+                    logger.info("🔄 Файл в облаке новее (%s > %s). Скачивание...", current_drive_time, LAST_FILE_DRIVE_TIME)
+                    try:
+                        async with download_lock:
+                            # Файл мог обновить параллельный /refresh, пока мы ждали
+                            if LAST_FILE_DRIVE_TIME is not None and current_drive_time <= LAST_FILE_DRIVE_TIME:
+                                downloaded = True
+                            else:
+                                downloaded = await run_drive_call(
+                                    fm.download_file, LAST_FILE_ID, LAST_FILE_LOCAL_PATH, modified_time=current_drive_time
+                                )
+                        if downloaded:
+                            LAST_FILE_DRIVE_TIME = current_drive_time
+                            save_last_file_meta()
+                            logger.info("✅ Файл обновлён: %s", LAST_FILE_LOCAL_PATH)
+                        else:
+                            logger.error("❌ Не удалось скачать обновлённый файл. Используем старую версию.")
+                            await safe_reply(update.message, get_message('file_update_error'))
+                    except Exception as e:
+                        logger.error("❌ Ошибка при скачивании файла: %s", e, exc_info=True)
+                        await safe_reply(update.message, get_message('file_update_success'))
+        except Exception as e:
+            logger.error("❌ Критическая ошибка при проверке обновления файла: %s", e, exc_info=True)
+            await safe_reply(update.message, get_message('search_error'))
 
     # Поиск по локальному файлу
     try:
-        # Используем асинхронный поиск для каждого номера
+        # Все номера ищем одной задачей по одному индексу файла
         lds = LocalDataSearcher()
-        all_results = []
-        for number in numbers:
-            logger.info(f"Начинаю поиск для СН: {number}")
-            results = await lds.search_by_number_async(LAST_FILE_LOCAL_PATH, number)
-            logger.info(f"Завершен поиск для СН: {number}, найдено результатов: {len(results)}")
-            all_results.extend(results)
+        logger.info("Начинаю поиск для СН: %s", ', '.join(numbers))
+        all_results = await lds.search_by_numbers_async(LAST_FILE_LOCAL_PATH, numbers)
+        logger.info("Завершен поиск для СН: %s, найдено результатов: %s", ', '.join(numbers), len(all_results))
         if not all_results:
             if len(numbers) == 1:
                 await update.message.reply_text(
@@ -1455,36 +2126,20 @@ async def handle_search(update: Update, query: str, user=None, username=None):
                 )
             else:
                 await update.message.reply_text(
-                    f"Терминалы с СН {', '.join(numbers)} не найдены.",
+                    get_message('no_terminal_multi', numbers=', '.join(numbers)),
                     parse_mode='HTML'
                 )
             return
 
-        # Отправляем результаты по одному
-        for result in all_results:
-            try:
-                if len(result) > 4096:
-                    truncated = result[:4050] + "<i>... (обрезано)</i>"
-                    await update.message.reply_text(truncated, parse_mode='HTML')
-                else:
-                    await update.message.reply_text(result, parse_mode='HTML')
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки результата: {e}")
-                try:
-                    await update.message.reply_text(
-                        "Нашёл терминал, но не могу показать — что-то сломалось./n"
-                        "Попробуй позже или скажи админу."
-                    )
-                except Exception as e_inner:
-                    logger.error(f"❌ Ошибка отправки fallback-сообщения: {e_inner}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка при поиске в Excel: {e}", exc_info=True)
-        try:
-            await update.message.reply_text(
-                get_message('search_error')
+        # Отправляем результаты, склеивая карточки в сообщения до лимита Telegram
+        for message_text in pack_messages(all_results):
+            await safe_reply(
+                update.message, message_text, parse_mode='HTML',
+                fallback=get_message('result_send_error')
             )
-        except Exception as e_inner:
-            logger.error(f"❌ Ошибка отправки сообщения об ошибке чтения: {e_inner}")
+    except Exception as e:
+        logger.error("❌ Ошибка при поиске в Excel: %s", e, exc_info=True)
+        await safe_reply(update.message, get_message('search_error'))
 
 # Обработчик команды /refresh ---
 async def refresh_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1498,37 +2153,72 @@ async def refresh_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user = update.effective_user
     # Проверяем, является ли пользователь администратором
-    if not user.username or user.username.lower() not in {u.lower() for u in ALLOWED_USERS}:
+    if not is_admin(user):
         await update.message.reply_text("❌ Доступ запрещён.")
         return
-    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH
+    global LAST_FILE_ID, LAST_FILE_DATE, LAST_FILE_DRIVE_TIME, LAST_FILE_LOCAL_PATH, last_drive_check
     # Проверяем наличие данных о файле
     if not LAST_FILE_ID or not LAST_FILE_LOCAL_PATH:
         await update.message.reply_text("❌ Нет данных о файле для обновления.")
         return
     try:
         await update.message.reply_text("🔄 Обновление файла с Google Drive...")
-        gs = GoogleServices()
-        fm = FileManager(gs.drive)
+        fm = file_manager()
         # Получаем текущее время файла в Google Drive
-        current_drive_time = fm.get_file_modified_time(LAST_FILE_ID)
+        current_drive_time = await run_drive_call(fm.get_file_modified_time, LAST_FILE_ID)
         if not current_drive_time:
             await update.message.reply_text("❌ Не удалось получить время изменения файла.")
             return
+        last_drive_check = time.monotonic()
         # Скачиваем файл
-        if fm.download_file(LAST_FILE_ID, LAST_FILE_LOCAL_PATH):
+        async with download_lock:
+            downloaded = await run_drive_call(
+                fm.download_file, LAST_FILE_ID, LAST_FILE_LOCAL_PATH, modified_time=current_drive_time
+            )
+        if downloaded:
             LAST_FILE_DRIVE_TIME = current_drive_time
+            save_last_file_meta()
+            await asyncio.to_thread(warm_sheet_index, LAST_FILE_LOCAL_PATH)
             await update.message.reply_text(
                 f"✅ Файл успешно обновлён!\n"
                 f"Дата изменения: {current_drive_time.strftime('%d.%m.%Y %H:%M:%S')}"
             )
-            logger.info(f"🔄 Файл обновлён администратором {user.username}")
+            logger.info("🔄 Файл обновлён администратором %s", user.username)
         else:
             await update.message.reply_text("❌ Не удалось обновить файл.")
     except Exception as e:
-        logger.error(f"❌ Ошибка при обновлении файла: {e}")
+        logger.error("❌ Ошибка при обновлении файла: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при обновлении файла.")
 
+def extract_mention_query(text: str, bot_username: str) -> Optional[str]:
+    """
+    Ищет упоминание бота (@bot_username запрос) без регулярных выражений.
+    Регистр username не важен; после упоминания должен идти пробел или конец текста.
+    Запросом считается текст до конца строки, как и прежде у регулярного выражения.
+    Поиск и срез выполняются по одной строке в нижнем регистре: lower() может
+    изменить длину строки (например, 'İ'), и позиции в исходном тексте
+    с ней бы не совпали. Регистр запроса не важен — extract_number
+    всё равно приводит номера к верхнему регистру.
+    Args:
+        text (str): Текст сообщения
+        bot_username (str): Username бота
+    Returns:
+        Optional[str]: Строка запроса после упоминания в нижнем регистре или None, если бот не упомянут
+    """
+    if not bot_username:
+        return None
+    lowered = text.lower()
+    tag = '@' + bot_username.lower()
+    i = lowered.find(tag)
+    while i >= 0:
+        j = i + len(tag)
+        if j == len(lowered) or lowered[j].isspace():
+            # Пробелы и переводы строк сразу после упоминания пропускаем,
+            # а следующие строки сообщения в запрос не попадают
+            return lowered[j:].lstrip().split('\n', 1)[0].strip()
+        i = lowered.find(tag, j)
+    return None
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработка сообщений: только команды и упоминания в чатах.
@@ -1540,7 +2230,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = update.message.text.strip()
-    bot_username = context.bot.username.lower() if context.bot.username else ""
+    # Регистр не важен: extract_mention_query сравнивает username без учёта регистра
+    bot_username = context.bot.username or ""
     chat_type = update.message.chat.type
     user = update.effective_user
 
@@ -1550,26 +2241,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверяем доступ в приватном чате
     if chat_type == 'private':
-        if not user.username or not access_manager.is_allowed(user.username.lower()):
+        if not user.username or not access_manager.is_allowed(user.username):
             await update.message.reply_text(get_message('access_denied'))
             return
 
         # Проверяем лимиты DDoS
-        username = user.username if user.username else str(user.id)
-        if not check_user_limit(username):
-            # Получаем время до разблокировки
-            ban_start = user_ban_start_times.get(username)
-            ban_time = user_ban_times.get(username, 10)
-            if ban_start:
-                remaining_time = ban_start + timedelta(minutes=ban_time) - (datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET))
-                minutes_left = int(remaining_time.total_seconds() // 60)
-                await update.message.reply_text(
-                    f"Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
-                    f"Пожалуйста, подожди {minutes_left} минут и попробуй снова.",
-                    parse_mode='HTML'
-                )
-            else:
-                await update.message.reply_text(get_message('ddos_blocked'), parse_mode='HTML')
+        if not await enforce_rate_limit(update, user):
             return
 
         # Обработка команды /s
@@ -1578,7 +2255,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not query:
                 await update.message.reply_text(get_message('missing_number'), parse_mode='HTML')
                 return
-            await handle_search(update, query, user, username)
+            await handle_search(update, query, user)
             return
 
         # Обработка других команд
@@ -1591,25 +2268,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # В групповых чатах (group/supergroup) — только команды и упоминания
     if chat_type in ['group', 'supergroup']:
+        # Обычная переписка (не команда и без упоминания) боту не адресована:
+        # отбрасываем её сразу, не тратя лимиты пользователя и поиск упоминания
+        if not text.startswith('/') and '@' not in text:
+            return
         # Проверяем лимиты DDoS
-        username = user.username if user.username else str(user.id)
-        
-        if not check_user_limit(username):
-            # Получаем время до разблокировки
-            ban_start = user_ban_start_times.get(username)
-            ban_time = user_ban_times.get(username, 10)
-            if ban_start:
-                remaining_time = ban_start + timedelta(minutes=ban_time) - (datetime.now(timezone.utc) + timedelta(hours=TIMEZONE_OFFSET))
-                minutes_left = int(remaining_time.total_seconds() // 60)
-                await update.message.reply_text(
-                    f"Ты слишком быстро пишешь! Тебе нужно немного передышки.\n"
-                    f"Пожалуйста, подожди {minutes_left} минут и попробуй снова.",
-                    parse_mode='HTML'
-                )
-            else:
-                await update.message.reply_text(get_message('ddos_blocked'), parse_mode='HTML')
+        if not await enforce_rate_limit(update, user):
             return
-        
+
         if text.lower() == "/ping":
             await ping(update, context)
             return
@@ -1621,15 +2287,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not query:
                 await update.message.reply_text(get_message('missing_number'), parse_mode='HTML')
                 return
-            await handle_search(update, query, user, username)
+            await handle_search(update, query, user)
             return # Завершаем обработку после команды
 
         # 2. Обработка упоминания бота в группе (например, @Sklad_bot 123456)
         #    Это должно быть вне условия text.startswith("/s")
-        mention_match = re.search(rf'@{re.escape(bot_username)}\s+(.+)', text, re.IGNORECASE)
-        
-        if mention_match:
-            query = mention_match.group(1).strip()
+        query = extract_mention_query(text, bot_username)
+
+        if query is not None:
             if not query:
                 await update.message.reply_text(
                     "Укажи серийный номер после упоминания бота.\n"
@@ -1637,10 +2302,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
                 return
-            # --- ИСПРАВЛЕНИЕ ---
-            # Извлекаем username из user объекта (уже есть выше)
-            # username = user.username if user.username else str(user.id) # Уже определено
-            await handle_search(update, query, user, username) # передаем username
+            await handle_search(update, query, user)
             return # Завершаем обработку после упоминания
 
         # Все остальные сообщения в группе — игнорируем
@@ -1649,10 +2311,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Для каналов (channel) — только упоминания (если бот добавлен как админ)
     if chat_type == 'channel':
         # Проверяем упоминание: @Sklad_bot ...
-        username = user.username if user.username else str(user.id)
-        mention_match = re.search(rf'@{re.escape(bot_username)}\s+(.+)', text, re.IGNORECASE)
-        if mention_match:
-            query = mention_match.group(1).strip()
+        query = extract_mention_query(text, bot_username)
+        if query is not None:
+            # Проверяем лимиты DDoS
+            if not await enforce_rate_limit(update, user):
+                return
             if not query:
                 # Отправка сообщений в каналы может быть ограничена
                 logger.warning("Попытка ответить в канале на пустой запрос. Это может не сработать.")
@@ -1660,7 +2323,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # await update.message.reply_text(...) # Можем не иметь права отвечать
                 logger.info("Получено упоминание в канале с пустым запросом.")
                 return
-            await handle_search(update, query, user, username) # передаем username
+            await handle_search(update, query, user)
             return
         # Все остальные сообщения в канале — игнорируем
         return
@@ -1687,6 +2350,39 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"❌ Ошибка при отправке ответа на /ping: {e}")
 
+async def post_init(application: Application):
+    """
+    Асинхронная инициализация после создания приложения.
+    Загружает чёрный и белый списки и последний файл склада уже внутри
+    цикла событий; обе загрузки независимы и выполняются одновременно.
+    Args:
+        application (Application): Приложение Telegram бота
+    """
+    global download_lock, drive_semaphore
+    # Общий пул потоков используется и для run_in_executor(None, ...)
+    asyncio.get_running_loop().set_default_executor(executor)
+    # Примитивы синхронизации создаём уже в цикле, который выполняет run_polling
+    download_lock = asyncio.Lock()
+    drive_semaphore = asyncio.Semaphore(DRIVE_MAX_CONCURRENCY)
+    # Время старта ≈ самая долгая из двух загрузок, а не их сумма
+    await asyncio.gather(
+        access_manager.update_lists(),
+        asyncio.to_thread(preload_latest_file),
+    )
+    # Фоновая очистка лимитов; задача не должна ожидаться при остановке,
+    # поэтому создаётся напрямую в цикле и отменяется в post_stop
+    application.bot_data['rate_limit_gc'] = asyncio.get_running_loop().create_task(gc_rate_limits())
+
+async def post_stop(application: Application):
+    """
+    Остановка фоновых задач при завершении работы бота.
+    Args:
+        application (Application): Приложение Telegram бота
+    """
+    task = application.bot_data.pop('rate_limit_gc', None)
+    if task:
+        task.cancel()
+
 def main():
     """
     Основная функция запуска бота.
@@ -1698,20 +2394,27 @@ def main():
         logger.critical(f"❌ Критическая ошибка: {e}")
         return
 
+    # Если установлен uvloop, run_polling создаст цикл событий через его политику
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ Используется цикл событий uvloop")
+
     # Создаем приложение Telegram бота
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Ограничитель исходящих запросов: общий лимит Telegram (~30 сообщений/с),
+    # лимит для групп и повтор после RetryAfter вместо ошибки
+    rate_limiter = AIORateLimiter(overall_max_rate=SEND_MAX_RATE, max_retries=SEND_MAX_RETRIES)
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(rate_limiter)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
 
-    # Инициализация AccessManager
+    # Инициализация AccessManager (списки и последний файл загружаются в post_init)
     global access_manager
-    gs = GoogleServices()
-    access_manager = AccessManager(gs.drive)
-    access_manager.update_lists()
-
-    # Предзагружаем последний файл
-    preload_latest_file()
-
-    # Регистрируем функцию для удаления временного файла при выходе
-    atexit.register(lambda: os.remove("temp_google_creds.json") if os.path.exists("temp_google_creds.json") else None)
+    access_manager = AccessManager(drive_service())
 
     # Добавляем обработчики команд
     app.add_handler(CommandHandler("start", start))
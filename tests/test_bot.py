@@ -0,0 +1,102 @@
+import os
+import pickle
+
+import openpyxl
+import pytest
+
+import bot
+
+
+def test_extract_mention_query_returns_query_after_mention():
+    assert bot.extract_mention_query("@Sklad_bot AB123456", "Sklad_bot") == "ab123456"
+
+
+def test_extract_mention_query_ignores_other_usernames():
+    assert bot.extract_mention_query("@Sklad_botX AB123456", "Sklad_bot") is None
+
+
+def test_extract_mention_query_with_length_changing_lowercase_before_tag():
+    # 'İ'.lower() — два символа: позиции в исходном тексте и в lower() расходятся
+    assert bot.extract_mention_query("İİ@sklad_bot", "Sklad_bot") == ""
+
+
+def test_extract_mention_query_finds_mention_after_length_changing_char():
+    assert bot.extract_mention_query("İ @sklad_bot 12", "Sklad_bot") == "12"
+
+
+def test_extract_mention_query_stops_at_end_of_line():
+    assert bot.extract_mention_query("@Sklad_bot AB123\nAB456", "Sklad_bot") == "ab123"
+    assert bot.extract_mention_query("@Sklad_bot AB123\nplease check", "Sklad_bot") == "ab123"
+
+
+def test_extract_mention_query_skips_line_break_after_mention():
+    assert bot.extract_mention_query("@Sklad_bot\nAB123", "Sklad_bot") == "ab123"
+
+
+# Строка листа "Терминалы": столбцы A..R, карточка собирается из E..Q
+TERMINAL_ROW = [
+    "a", "b", "c", "d",
+    "POS-терминал",     # E: тип оборудования
+    "AB123456",         # F: СН
+    "Ingenico",         # G: модель
+    1001,               # H: заявка
+    "Зарезервировано",  # I: статус
+    "j", "k", "l", "m",
+    "A-1",              # N: место на складе
+    "Выдан",            # O: статус выдачи
+    "Иванов",           # P: инженер
+    "01.02.2026",       # Q: дата выдачи
+    "лишнее",           # R: за пределами карточки
+]
+
+EXPECTED_CARD = [
+    "ℹ️ <b>Информация о терминале</b>",
+    "<b>СН:</b> <code>AB123456</code>",
+    "<b>Тип оборудования:</b> <code>POS-терминал</code>",
+    "<b>Модель терминала:</b> <code>Ingenico</code>",
+    "<b>Статус оборудования:</b> <code>Зарезервировано</code>",
+    "<b>Место на складе:</b> <code>A-1</code>",
+    "<b>Заявка:</b> <code>1001</code>",
+    "<b>Выдан инженеру:</b> <code>Иванов</code>",
+    "<b>Дата выдачи:</b> <code>01.02.2026</code>",
+]
+
+
+def write_warehouse(path):
+    wb = openpyxl.Workbook()
+    sheet = wb.active
+    sheet.title = "Терминалы"
+    sheet.append([f"Заголовок {i}" for i in range(len(TERMINAL_ROW))])
+    sheet.append(TERMINAL_ROW)
+    wb.save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("use_calamine", [True, False])
+def test_search_by_numbers_builds_card_from_columns_e_to_q(tmp_path, monkeypatch, use_calamine):
+    if use_calamine and bot.CalamineWorkbook is None:
+        pytest.skip("python-calamine не установлен")
+    if not use_calamine:
+        monkeypatch.setattr(bot, "CalamineWorkbook", None)
+    monkeypatch.setattr(bot, "sheet_index_cache", {})
+    path = write_warehouse(tmp_path / "sklad.xlsx")
+
+    results = bot.LocalDataSearcher._search_by_numbers_sync(path, ["ab123456", "XX000000"])
+
+    assert len(results) == 1
+    assert results[0].split("\n") == EXPECTED_CARD
+
+
+def test_index_sidecar_with_other_format_version_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "sheet_index_cache", {})
+    path = write_warehouse(tmp_path / "sklad.xlsx")
+    mtime = os.path.getmtime(path)
+    stale = {'version': bot.INDEX_FORMAT_VERSION - 1, 'mtime': mtime, 'index': {"AB123456": [("старый",)]}}
+    with open(path + bot.INDEX_SIDECAR_SUFFIX, 'wb') as fh:
+        pickle.dump(stale, fh)
+
+    assert bot.LocalDataSearcher._load_index_sidecar(path, mtime) is None
+    results = bot.LocalDataSearcher._search_by_numbers_sync(path, ["AB123456"])
+    assert results[0].split("\n") == EXPECTED_CARD
+    # Индекс пересобран и сохранён в текущем формате
+    assert bot.LocalDataSearcher._load_index_sidecar(path, mtime) is not None